@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from .library import library_path
+
+INDEX_TYPES = ["flat", "hnsw", "ivfpq"]
+
+
+class ANNIndex:
+    """Approximate nearest neighbour index over the vectors of a split library.
+
+    Backed by faiss, either an HNSW graph or an IVF-PQ index, both ranking by
+    L2 distance like the exact search. Index ids are row ids of the split
+    library, so the index is brought up to date by adding the rows appended
+    since it was last saved. It is saved as `<lib>.<kind>.faiss`, and read
+    from `shared_dir` instead if given, like the split library files.
+    """
+
+    def __init__(
+        self, lib_name, kind="hnsw", hnsw_m=32, ef_search=128, nprobe=16, shared_dir=None
+    ):
+        if kind not in INDEX_TYPES[1:]:
+            raise ValueError("Unknown index type %s." % kind)
+        self.lib_name = lib_name
+        self.kind = kind
+        if shared_dir:
+            self.path = os.path.join(shared_dir, "%s.%s.faiss" % (lib_name, kind))
+        else:
+            self.path = library_path(lib_name, ".%s.faiss" % kind)
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.index = None
+
+    def __len__(self):
+        return 0 if self.index is None else self.index.ntotal
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self, mmap=False):
+        """Read the saved index; with `mmap`, its data is mapped read-only
+        instead, so processes loading the same file share it, but no rows can
+        be added to it."""
+        import faiss
+
+        self.index = faiss.read_index(self.path, faiss.IO_FLAG_MMAP if mmap else 0)
+        self._configure()
+        return self
+
+    def save(self):
+        import faiss
+
+        tmp_path = self.path + ".tmp"
+        faiss.write_index(self.index, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def _configure(self):
+        if self.kind == "hnsw":
+            self.index.hnsw.efSearch = self.ef_search
+        else:
+            self.index.nprobe = self.nprobe
+
+    def _create(self, vectors):
+        import faiss
+
+        dim = vectors.shape[1]
+        if self.kind == "hnsw":
+            self.index = faiss.IndexHNSWFlat(dim, self.hnsw_m)
+            self.index.hnsw.efConstruction = 80
+        else:
+            if len(vectors) < 10000:
+                raise ValueError(
+                    "IVF-PQ needs at least 10000 chunks to train, the library has %d."
+                    % len(vectors)
+                )
+            nlist = int(4 * np.sqrt(len(vectors)))
+            m = next(m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1) if dim % m == 0)
+            self.index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, m, 8)
+            sample = np.random.default_rng(0).choice(
+                len(vectors), min(len(vectors), 256 * nlist), replace=False
+            )
+            self.index.train(np.ascontiguousarray(vectors[np.sort(sample)], dtype=np.float32))
+        self._configure()
+
+    def update(self, vectors, block_rows=65536):
+        """Add the rows of `vectors` the index does not cover yet."""
+        if len(vectors) == 0:
+            return 0
+        if self.index is None:
+            self._create(vectors)
+        start = self.index.ntotal
+        for i in range(start, len(vectors), block_rows):
+            self.index.add(np.ascontiguousarray(vectors[i : i + block_rows], dtype=np.float32))
+        return len(vectors) - start
+
+    def search(self, query, k):
+        """Ids and squared L2 distances of about `k` nearest rows, nearest first."""
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        distances, ids = self.index.search(query, k)
+        found = ids[0] >= 0
+        return ids[0][found].astype(np.int64), distances[0][found]
+
+
+def recall_at_k(store, index, k=10, num_queries=200, seed=0, noise=0.5):
+    """Fraction of the exact top-k rows the index also returns.
+
+    Queries are held out from the library: random library vectors moved by
+    gaussian noise of `noise` times their norm, since a library vector is
+    its own nearest row and would inflate the recall. Each is searched with
+    both the index and the store's exact search.
+    """
+    if len(store.vectors) == 0:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(store.vectors), min(num_queries, len(store.vectors)), replace=False)
+    found = 0
+    for row in rows:
+        vector = np.asarray(store.vectors[row], dtype=np.float32)
+        step = rng.normal(size=vector.shape).astype(np.float32)
+        step *= noise * np.linalg.norm(vector) / max(np.linalg.norm(step), 1e-12)
+        query = vector + step
+        exact, _ = store.exact_search(query, k)
+        approximate, _ = index.search(query, k)
+        found += len(set(exact.tolist()) & set(approximate.tolist()))
+    return found / (len(rows) * min(k, len(store.vectors)))
+
+
+def build_index(lib_name, kind, k=10):
+    """Create or update the ANN index of a split library and report its recall."""
+    from .split_library import SplitLibrary
+    from .vectorstore import MatrixVectorStore
+
+    vectors = SplitLibrary(lib_name).vectors()
+    index = ANNIndex(lib_name, kind)
+    if index.exists():
+        index.load()
+    added = index.update(vectors)
+    index.save()
+    store = MatrixVectorStore(vectors, None, None)
+    recall = recall_at_k(store, index, k=k)
+    print(
+        "%s index of %d chunks (%d new) saved in %s, recall@%d against exact search: %.3f"
+        % (kind, len(index), added, os.path.abspath(index.path), k, recall)
+    )
+    return index, recall
@@ -0,0 +1,196 @@
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from .library import library_path, library_version
+
+
+def normalize_question(question):
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+
+class AnswerCache:
+    """Answers already given for a library, stored in `<lib>.answers.sqlite`.
+
+    A question is answered from the cache if its normalized text was asked
+    before with the same `scope` (e.g. the index and retrieval mode). With a
+    `threshold` below 1 and `embeddings`, a question whose embedding has
+    cosine similarity of at least `threshold` with an earlier question is
+    answered from the cache too. Entries expire after `ttl` seconds, the
+    least recently used ones are dropped beyond `max_entries`, and the whole
+    cache is cleared when the library it was built for changes.
+    """
+
+    def __init__(
+        self,
+        lib_name,
+        embeddings=None,
+        threshold=1.0,
+        ttl=7 * 24 * 3600,
+        max_entries=10000,
+        shared_dir=None,
+        scope="",
+    ):
+        # a list of names caches answers for those libraries queried together
+        self.lib_names = [lib_name] if isinstance(lib_name, str) else list(lib_name)
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared_dir = shared_dir
+        self.scope = scope + ":"
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            library_path("+".join(self.lib_names), ".answers.sqlite"),
+            check_same_thread=False,
+        )
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS answers (question TEXT PRIMARY KEY, answer TEXT, "
+            "vector BLOB, created REAL, last_used REAL);"
+        )
+        self.check_version()
+
+    def check_version(self, version=None):
+        """Clear the cache if the library changed since the answers were stored.
+
+        `version` is the version of the libraries being served, read from
+        their files (in `shared_dir` if given) by default.
+        """
+        if version is None:
+            version = ";".join(
+                library_version(lib_name, self.shared_dir) for lib_name in self.lib_names
+            )
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+            if row is None or row[0] != version:
+                self.db.execute("DELETE FROM answers")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+                self.db.commit()
+            self._load_vectors()
+
+    @property
+    def semantic(self):
+        return self.embeddings is not None and self.threshold < 1
+
+    def _key(self, question):
+        return self.scope + normalize_question(question)
+
+    def _load_vectors(self):
+        rows = self.db.execute(
+            "SELECT question, vector FROM answers WHERE vector IS NOT NULL "
+            "AND substr(question, 1, ?) = ?",
+            (len(self.scope), self.scope),
+        ).fetchall()
+        self.questions = [row[0] for row in rows]
+        self.vectors = [np.frombuffer(row[1], dtype=np.float32) for row in rows]
+        self.positions = {question: i for i, question in enumerate(self.questions)}
+
+    def _forget(self, keys):
+        for key in keys:
+            i = self.positions.pop(key, None)
+            if i is None:
+                continue
+            # move the last vector into the freed slot
+            last = self.questions.pop()
+            vector = self.vectors.pop()
+            if last != key:
+                self.questions[i] = last
+                self.vectors[i] = vector
+                self.positions[last] = i
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def _nearest(self, vector):
+        if not self.vectors:
+            return None
+        similarities = np.stack(self.vectors) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return self.questions[best]
+
+    def lookup(self, question):
+        """(cached answer or None, embedding of `question` or None).
+
+        The embedding is only computed for semantic matching, and can be
+        passed to `put` so the question is not embedded twice.
+        """
+        key = self._key(question)
+        vector = None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT answer, created FROM answers WHERE question=?", (key,)
+            ).fetchone()
+        if row is None and self.semantic:
+            vector = self._embed(question)
+            with self.lock:
+                match = self._nearest(vector)
+                if match is not None:
+                    row = self.db.execute(
+                        "SELECT answer, created FROM answers WHERE question=?", (match,)
+                    ).fetchone()
+                    key = match
+        with self.lock:
+            if row is None or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                return None, vector
+            if vector is None:
+                self.exact_hits += 1
+            else:
+                self.semantic_hits += 1
+            self.db.execute(
+                "UPDATE answers SET last_used=? WHERE question=?", (time.time(), key)
+            )
+            self.db.commit()
+            return row[0], vector
+
+    def get(self, question):
+        """The cached answer to `question`, or None."""
+        return self.lookup(question)[0]
+
+    def put(self, question, answer, vector=None):
+        """Store `answer`; `vector` is the embedding `lookup` returned, if any."""
+        key = self._key(question)
+        if vector is None and self.semantic:
+            vector = self._embed(question)
+        if not self.semantic:
+            vector = None
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                (key, answer, None if vector is None else vector.tobytes(), now, now),
+            )
+            stale = [
+                row[0]
+                for row in self.db.execute(
+                    "SELECT question FROM answers WHERE created < ? UNION "
+                    "SELECT question FROM answers WHERE question NOT IN "
+                    "(SELECT question FROM answers ORDER BY last_used DESC LIMIT ?)",
+                    (now - self.ttl, self.max_entries),
+                )
+            ]
+            self.db.executemany("DELETE FROM answers WHERE question=?", [(k,) for k in stale])
+            self.db.commit()
+            self._forget(stale + [key])
+            if vector is not None and key not in stale:
+                self.positions[key] = len(self.questions)
+                self.questions.append(key)
+                self.vectors.append(vector)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            }
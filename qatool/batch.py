@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+# tokens reserved for a question before its real usage is known
+DEFAULT_QUESTION_TOKENS = 4000
+
+
+class TokenRateLimiter:
+    """Keeps LLM usage under `tokens_per_minute` over a sliding minute.
+
+    A question reserves an estimate of its tokens before it starts and the
+    estimate is corrected with the tokens it actually used once it is done.
+    The estimate is the average usage of the questions answered so far.
+    """
+
+    def __init__(self, tokens_per_minute=None, estimate=DEFAULT_QUESTION_TOKENS):
+        self.tokens_per_minute = tokens_per_minute
+        self.estimate = estimate
+        self.window = deque()
+        self.used = 0
+        self.answered = 0
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= 60:
+            self.window.popleft()
+
+    def _in_window(self):
+        return sum(tokens for _, tokens in self.window)
+
+    async def acquire(self):
+        """Wait until the estimated tokens of one question fit in the budget."""
+        tokens = self.estimate
+        if self.tokens_per_minute is not None:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                if not self.window or self._in_window() + tokens <= self.tokens_per_minute:
+                    break
+                await asyncio.sleep(60 - (now - self.window[0][0]))
+        self.window.append((time.monotonic(), tokens))
+        return tokens
+
+    def record(self, reserved, tokens):
+        """Correct a reservation of `reserved` tokens with the `tokens` used.
+
+        A question that failed records 0, which releases its reservation.
+        """
+        self.window.append((time.monotonic(), tokens - reserved))
+        if tokens:
+            self.used += tokens
+            self.answered += 1
+            self.estimate = self.used / self.answered
+
+
+def read_questions(path):
+    """(id, question) pairs from a text file, one question per line, or a JSONL
+    file of objects with a "question" and an optional "id"."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                questions.append((str(item.get("id", number)), item["question"]))
+            else:
+                questions.append((str(number), line))
+    return questions
+
+
+def read_answered(path):
+    """Ids already answered in a JSONL output file.
+
+    A last line cut short by an interruption is removed, so new answers are
+    appended after the last complete one.
+    """
+    if not os.path.exists(path):
+        return set()
+    answered = set()
+    valid = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                answered.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            valid += len(line)
+    if valid < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(valid)
+    return answered
+
+
+def _token_count(answer):
+    # token_counts maps each model to [prompt tokens, completion tokens]
+    counts = getattr(answer, "token_counts", None) or {}
+    return sum(sum(tokens) for tokens in counts.values())
+
+
+def answer_record(question_id, answer, seconds):
+    return {
+        "id": question_id,
+        "question": answer.question,
+        "answer": answer.answer,
+        "formatted_answer": answer.formatted_answer,
+        "references": answer.references,
+        "contexts": [
+            {
+                "name": context.text.name,
+                "citation": context.text.doc.citation,
+                "text": context.text.text,
+                "summary": context.context,
+                "score": context.score,
+            }
+            for context in answer.contexts
+        ],
+        "cost": getattr(answer, "cost", None),
+        "token_counts": getattr(answer, "token_counts", None),
+        "seconds": seconds,
+    }
+
+
+async def _answer_all(docs, questions, output, concurrency, limiter, k, max_sources):
+    semaphore = asyncio.Semaphore(concurrency)
+    write_lock = asyncio.Lock()
+    failed = []
+
+    async def answer_one(question_id, question):
+        async with semaphore:
+            reserved = await limiter.acquire()
+            start = time.perf_counter()
+            try:
+                answer = await docs.aquery(question, k=k, max_sources=max_sources)
+            except Exception as exception:
+                limiter.record(reserved, 0)
+                print("Question %s failed: %s" % (question_id, exception))
+                failed.append(question_id)
+                return
+            limiter.record(reserved, _token_count(answer))
+            record = answer_record(question_id, answer, time.perf_counter() - start)
+            async with write_lock:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+
+    if questions:
+        # paperqa builds its indexes on the first query, so it runs alone
+        await answer_one(*questions[0])
+    await asyncio.gather(*(answer_one(*item) for item in questions[1:]))
+    return failed
+
+
+def run_batch(
+    docs,
+    questions_file,
+    output_file,
+    concurrency=4,
+    tokens_per_minute=None,
+    k=10,
+    max_sources=10,
+):
+    """Answer every question of `questions_file` and append the results to
+    `output_file` as JSONL, skipping questions answered by an earlier run."""
+    questions = read_questions(questions_file)
+    answered = read_answered(output_file)
+    remaining = [item for item in questions if item[0] not in answered]
+    print(
+        "%d questions, %d already answered in %s."
+        % (len(questions), len(questions) - len(remaining), output_file)
+    )
+    limiter = TokenRateLimiter(tokens_per_minute)
+    start = time.perf_counter()
+    with open(output_file, "a", encoding="utf-8") as output:
+        failed = asyncio.run(
+            _answer_all(docs, remaining, output, concurrency, limiter, k, max_sources)
+        )
+    print(
+        "Answered %d questions in %.1f s using %d tokens, %d failed and will be retried on the next run."
+        % (len(remaining) - len(failed), time.perf_counter() - start, limiter.used, len(failed))
+    )
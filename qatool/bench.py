@@ -0,0 +1,306 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+FAKE_EMBEDDINGS = "bench-hash-768"
+
+VOCABULARY = (
+    "aging senescence mitochondria telomere autophagy inflammation sirtuin mtor "
+    "insulin igf1 rapamycin metformin nad caloric restriction lifespan healthspan "
+    "stem cell dna damage repair epigenetic clock methylation proteostasis "
+    "oxidative stress mouse worm yeast fly human cohort trial biomarker protein "
+    "gene expression pathway signaling receptor kinase tissue muscle brain liver"
+).split()
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings from hashed tokens, for offline runs."""
+
+    model_name = FAKE_EMBEDDINGS
+
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in text.lower().split():
+            digest = hashlib.md5(token.encode()).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        return (vector / max(np.linalg.norm(vector), 1e-12)).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class StubLLM(LLM):
+    """Language model that answers instantly with a fixed text."""
+
+    response: str = "Synthetic summary of the benchmark evidence (Bench2023)."
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        return self.response
+
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words)).capitalize() + "."
+
+
+def _pdf_escape(line):
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    """Write a minimal text-only PDF with one page per list of lines."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for lines in pages:
+        stream = "BT /F1 10 Tf 50 780 Td 12 TL " + " ".join(
+            "(%s) Tj T*" % _pdf_escape(line) for line in lines
+        ) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids),
+        len(kids),
+    )
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def make_corpus(doc_dir, num_docs, pdf_fraction=0.1, pdf_pages=8, seed=0):
+    """Write `num_docs` synthetic papers: abstract-sized .txt files and multi-page PDFs."""
+    rng = random.Random(seed)
+    os.makedirs(doc_dir, exist_ok=True)
+    num_pdfs = int(num_docs * pdf_fraction)
+    for i in range(num_docs):
+        if i < num_pdfs:
+            pages = [[_sentence(rng) for _ in range(50)] for _ in range(pdf_pages)]
+            write_pdf(os.path.join(doc_dir, "%08d.pdf" % i), pages)
+        else:
+            with open(os.path.join(doc_dir, "%08d.txt" % i), "w", encoding="utf-8") as f:
+                f.write(" ".join(_sentence(rng) for _ in range(rng.randint(8, 20))))
+    return num_pdfs
+
+
+def percentiles(seconds):
+    milliseconds = 1000 * np.asarray(seconds)
+    return {
+        "p50": float(np.percentile(milliseconds, 50)),
+        "p90": float(np.percentile(milliseconds, 90)),
+        "p99": float(np.percentile(milliseconds, 99)),
+        "mean": float(milliseconds.mean()),
+    }
+
+
+def _library_bytes(lib_name):
+    from .library import LIB_DIR
+
+    return sum(
+        os.path.getsize(os.path.join(LIB_DIR, f))
+        for f in os.listdir(LIB_DIR)
+        if f.startswith(lib_name + ".")
+    )
+
+
+def run_size(num_docs, pdf_fraction=0.1, num_queries=50, workers=1, batch_size=64):
+    """Benchmark ingestion and retrieval on a synthetic corpus of `num_docs` papers.
+
+    Runs in a scratch directory with the fake embedding model and stub LLM,
+    so nothing is downloaded and no API is called.
+    """
+    from .embedding import model_registry
+
+    model_registry.register(FAKE_EMBEDDINGS, HashEmbeddings())
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="qatool-bench-")
+    os.chdir(workdir)
+    try:
+        return _run_in(workdir, num_docs, pdf_fraction, num_queries, workers, batch_size)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _run_in(workdir, num_docs, pdf_fraction, num_queries, workers, batch_size):
+    from .library import load_library
+    from .qa import iter_embeddings, load_papers
+    from .split_library import SplitLibrary
+
+    os.makedirs("saved_libs")
+    doc_dir = os.path.join(workdir, "papers")
+    result = {"num_docs": num_docs}
+
+    start = time.perf_counter()
+    result["num_pdfs"] = make_corpus(doc_dir, num_docs, pdf_fraction)
+    result["corpus_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    num_chunks = sum(
+        1
+        for _ in iter_embeddings(
+            doc_dir, FAKE_EMBEDDINGS, workers=workers, batch_size=batch_size
+        )
+    )
+    seconds = time.perf_counter() - start
+    result["get_embeddings"] = {
+        "seconds": seconds,
+        "chunks": num_chunks,
+        "files_per_second": num_docs / seconds,
+        "chunks_per_second": num_chunks / seconds,
+    }
+
+    start = time.perf_counter()
+    load_papers(
+        doc_dir,
+        "bench",
+        FAKE_EMBEDDINGS,
+        workers=workers,
+        batch_size=batch_size,
+        cache_dir="",
+        llm=StubLLM(),
+        text_cache_dir="",
+    )
+    seconds = time.perf_counter() - start
+    result["load_papers"] = {
+        "seconds": seconds,
+        "files_per_second": num_docs / seconds,
+        "chunks_per_second": num_chunks / seconds,
+        "library_bytes": _library_bytes("bench"),
+    }
+
+    start = time.perf_counter()
+    docs = load_library("bench")
+    result["library_load_seconds"] = time.perf_counter() - start
+    SplitLibrary("bench").create(docs)
+    result["split_library_bytes"] = _library_bytes("bench") - result["load_papers"]["library_bytes"]
+    start = time.perf_counter()
+    lazy_docs = load_library("bench", lazy=True, llm=StubLLM())
+    result["split_library_load_seconds"] = time.perf_counter() - start
+
+    rng = random.Random(1)
+    questions = [_sentence(rng, words=8) for _ in range(num_queries)]
+    for name, library in (("pkl", docs), ("split", lazy_docs)):
+        if library.texts_index is None:
+            library._build_texts_index()
+        retrieval = []
+        query = []
+        for question in questions:
+            start = time.perf_counter()
+            library.texts_index.max_marginal_relevance_search(question, k=10, fetch_k=50)
+            retrieval.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            library.query(question, k=10, max_sources=10, key_filter=False)
+            query.append(time.perf_counter() - start)
+        result["%s_retrieval_latency_ms" % name] = percentiles(retrieval)
+        result["%s_query_latency_ms" % name] = percentiles(query)
+
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="Numbers of synthetic papers to benchmark, e.g. 1000 10000 100000. "
+        "Default value 1000 10000.",
+    )
+    parser.add_argument(
+        "--pdf_fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of the synthetic papers written as multi-page PDFs. Default value 0.1.",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=50,
+        help="Number of questions used to measure query latency. Default value 50.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse papers. Default value 1.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of chunks embedded together, across papers. Default value 64.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="./bench_results.json",
+        help="JSON file the results are written to. Default path './bench_results.json'.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "runs": [],
+    }
+    for size in args.sizes:
+        # a fresh process per size, so peak memory is measured per corpus
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(
+                run_size, size, args.pdf_fraction, args.queries, args.workers, args.batch_size
+            ).result()
+        print(json.dumps(result, indent=2))
+        results["runs"].append(result)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print("Benchmark results saved in %s" % os.path.abspath(args.output))
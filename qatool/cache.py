@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+from array import array
+
+DEFAULT_CACHE_DIR = "./saved_libs/embedding_cache"
+DEFAULT_TEXT_CACHE_DIR = "./saved_libs/text_cache"
+
+
+def embeddings_name(embeddings):
+    """Name identifying an embedding model object, used in cache keys.
+
+    Models quantized by `cpu_backend.quantize_model`, and worker pools running
+    them, get the backend appended.
+    """
+    backend = getattr(embeddings, "qatool_backend", None) or getattr(
+        getattr(embeddings, "client", None), "qatool_backend", None
+    )
+    for attr in ("model_name", "model"):
+        name = getattr(embeddings, attr, None)
+        if isinstance(name, str) and name:
+            return name if backend is None else "%s:%s" % (name, backend)
+    return type(embeddings).__name__
+
+
+class EmbeddingCache:
+    """On-disk cache of chunked texts and their embeddings for one file.
+
+    Entries are keyed by (file md5, embedding model name, chunk_chars), so a
+    file is only parsed and embedded again when its content, the model or the
+    chunk size changes. The chunks are kept in an SQLite index and the vectors
+    in one float32 file per entry. When the cache grows past `max_bytes` the
+    least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=10 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "dockey TEXT, model TEXT, chunk_chars INTEGER, vector_file TEXT, "
+            "count INTEGER, dim INTEGER, nbytes INTEGER, last_used REAL, texts BLOB, "
+            "PRIMARY KEY (dockey, model, chunk_chars))"
+        )
+        self.db.commit()
+
+    def _vector_file(self, dockey, model, chunk_chars):
+        key = hashlib.md5(f"{dockey}:{model}:{chunk_chars}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + ".f32")
+
+    def contains(self, dockey, model, chunk_chars):
+        row = self.db.execute(
+            "SELECT 1 FROM entries WHERE dockey=? AND model=? AND chunk_chars=?",
+            (dockey, model, chunk_chars),
+        ).fetchone()
+        return row is not None
+
+    def get(self, dockey, model, chunk_chars):
+        """Return (texts, vectors) for a cached file, or None on a miss."""
+        row = self.db.execute(
+            "SELECT vector_file, count, dim, texts FROM entries "
+            "WHERE dockey=? AND model=? AND chunk_chars=?",
+            (dockey, model, chunk_chars),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        vector_file, count, dim, texts = row
+        values = array("f")
+        try:
+            with open(vector_file, "rb") as f:
+                values.fromfile(f, count * dim)
+        except (OSError, EOFError):
+            self._delete(dockey, model, chunk_chars, vector_file)
+            self.misses += 1
+            return None
+        self.db.execute(
+            "UPDATE entries SET last_used=? WHERE dockey=? AND model=? AND chunk_chars=?",
+            (time.time(), dockey, model, chunk_chars),
+        )
+        self.db.commit()
+        self.hits += 1
+        vectors = [values[i * dim : (i + 1) * dim].tolist() for i in range(count)]
+        return pickle.loads(texts), vectors
+
+    def put(self, dockey, model, chunk_chars, texts, vectors):
+        if len(texts) == 0:
+            return
+        dim = len(vectors[0])
+        vector_file = self._vector_file(dockey, model, chunk_chars)
+        values = array("f")
+        for vector in vectors:
+            values.extend(vector)
+        with open(vector_file, "wb") as f:
+            values.tofile(f)
+        texts = pickle.dumps(
+            [t.copy(update={"embeddings": None}) for t in texts],
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        nbytes = len(values) * values.itemsize + len(texts)
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (dockey, model, chunk_chars, vector_file, len(vectors), dim, nbytes, time.time(), texts),
+        )
+        self.db.commit()
+        self.evict()
+
+    def _delete(self, dockey, model, chunk_chars, vector_file):
+        self.db.execute(
+            "DELETE FROM entries WHERE dockey=? AND model=? AND chunk_chars=?",
+            (dockey, model, chunk_chars),
+        )
+        self.db.commit()
+        if os.path.exists(vector_file):
+            os.remove(vector_file)
+
+    def size(self):
+        return self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        rows = self.db.execute(
+            "SELECT dockey, model, chunk_chars, vector_file, nbytes FROM entries "
+            "ORDER BY last_used"
+        ).fetchall()
+        for dockey, model, chunk_chars, vector_file, nbytes in rows:
+            if excess <= 0:
+                break
+            self._delete(dockey, model, chunk_chars, vector_file)
+            excess -= nbytes
+
+    def stats(self):
+        entries = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": self.size(),
+        }
+
+
+class TextCache:
+    """Text extracted from files, gzipped on disk and keyed by file md5.
+
+    Holds what `parse.extract_file` returns, before chunking, so the same
+    files can be chunked with another size or embedded with another model
+    without extracting their text again. One file per entry, written
+    atomically, so parse worker processes can share the cache. Entries
+    written by another `version` of the extraction are ignored.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_TEXT_CACHE_DIR, version=1):
+        self.cache_dir = cache_dir
+        self.version = version
+
+    def _path(self, dockey):
+        return os.path.join(self.cache_dir, dockey[:2], dockey + ".json.gz")
+
+    def get(self, dockey):
+        try:
+            with gzip.open(self._path(dockey), "rt", encoding="utf-8") as f:
+                kind, content, version = json.load(f)
+        except (OSError, EOFError, ValueError):
+            return None
+        if version != self.version:
+            return None
+        return kind, content
+
+    def put(self, dockey, extracted):
+        path = self._path(dockey)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(list(extracted) + [self.version], f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,154 @@
+import argparse
+import os
+import time
+import numpy as np
+
+BACKENDS = ["torch", "int8"]
+# smallest cosine similarity allowed between a vector of the int8 backend and
+# the vector of the reference model for the same text
+COSINE_TOLERANCE = 0.98
+
+
+def parse_cpu_list(cpus):
+    """CPU ids from a list like '0-3,8,10-11'."""
+    ids = set()
+    for part in cpus.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            ids.update(range(int(first), int(last) + 1))
+        elif part:
+            ids.add(int(part))
+    return ids
+
+
+def set_cpu_threads(threads=None, affinity=None):
+    """Pin this process to the `affinity` CPUs and run `threads` intra-op threads.
+
+    Without `threads`, one thread per CPU the process may run on. The OpenMP
+    and MKL variables are set too, for processes started from this one.
+    Returns the number of threads.
+    """
+    if affinity:
+        os.sched_setaffinity(0, parse_cpu_list(affinity) if isinstance(affinity, str) else affinity)
+    if threads is None:
+        threads = len(os.sched_getaffinity(0))
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    import torch
+
+    torch.set_num_threads(threads)
+    return threads
+
+
+def quantize_model(embeddings):
+    """Replace the linear layers of a HuggingFace embedding model with int8 ones.
+
+    Weights are quantized once and activations on the fly (dynamic
+    quantization), which only runs on CPU.
+    """
+    import torch
+
+    embeddings.client = torch.quantization.quantize_dynamic(
+        embeddings.client.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    # read by cache.embeddings_name, so cached vectors of each backend stay apart
+    embeddings.client.qatool_backend = "int8"
+    return embeddings
+
+
+def _timed_embed(embeddings, texts, batch_size):
+    from .embedding import embed_texts
+
+    # one batch first, so lazy initialization is not timed
+    embed_texts(embeddings, texts[:batch_size], batch_size)
+    start = time.perf_counter()
+    vectors = np.asarray(embed_texts(embeddings, texts, batch_size), dtype=np.float32)
+    return vectors, time.perf_counter() - start
+
+
+def compare_backends(name, texts, backend="int8", batch_size=64, tolerance=COSINE_TOLERANCE):
+    """Embed `texts` with the reference model and with `backend`, and compare
+    throughput and the cosine similarity of the two vectors of each text."""
+    from .embedding import get_embedding_model
+
+    reference, reference_seconds = _timed_embed(get_embedding_model(name), texts, batch_size)
+    candidate, candidate_seconds = _timed_embed(
+        get_embedding_model(name, backend=backend), texts, batch_size
+    )
+    cosines = np.einsum("ij,ij->i", reference, candidate) / np.maximum(
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1), 1e-12
+    )
+    return {
+        "texts": len(texts),
+        "reference_texts_per_second": len(texts) / reference_seconds,
+        "backend_texts_per_second": len(texts) / candidate_seconds,
+        "speedup": reference_seconds / candidate_seconds,
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "within_tolerance": bool(cosines.min() >= tolerance),
+    }
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "doc_dir", type=str, help="Directory or file of papers whose chunks are embedded."
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=str,
+        default="all-mpnet-base-v2",
+        help="Embedding model to compare. Default value 'all-mpnet-base-v2'.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS[1:],
+        default="int8",
+        help="Backend compared with the reference model. Default value 'int8'.",
+    )
+    parser.add_argument(
+        "--texts",
+        type=int,
+        default=512,
+        help="Number of chunks embedded. Default value 512.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of chunks embedded together. Default value 64.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads used by the model. One per CPU by default.",
+    )
+    parser.add_argument(
+        "--cpu_affinity",
+        type=str,
+        help="CPUs the process runs on, e.g. '0-7'. All by default.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from .parse import list_files, parse_files
+
+    args = get_arguments()
+    threads = set_cpu_threads(args.threads, args.cpu_affinity)
+    texts = []
+    for _, chunks, exception in parse_files(list_files(args.doc_dir)):
+        texts.extend(t.text for t in chunks)
+        if len(texts) >= args.texts:
+            break
+    report = compare_backends(args.embeddings, texts[: args.texts], args.backend, args.batch_size)
+    print(
+        "%(texts)d chunks: %(reference_texts_per_second).1f chunks/s with torch, "
+        "%(backend_texts_per_second).1f with the backend (%(speedup).2fx); "
+        "cosine with the reference min %(min_cosine).4f, mean %(mean_cosine).4f" % report
+    )
+    print(
+        "%s the tolerance of %.2f, using %d threads."
+        % ("Within" if report["within_tolerance"] else "NOT within", COSINE_TOLERANCE, threads)
+    )
@@ -0,0 +1,177 @@
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, words=5):
+    """Set of hashed `words`-word shingles of a normalized text."""
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    if len(tokens) <= words:
+        return {zlib.crc32(" ".join(tokens).encode())}
+    return {
+        zlib.crc32(" ".join(tokens[i : i + words]).encode())
+        for i in range(len(tokens) - words + 1)
+    }
+
+
+class ChunkDeduplicator:
+    """Drops chunks that are near duplicates of chunks seen before.
+
+    Every chunk gets a MinHash signature of its word shingles. Signatures are
+    split into `bands` bands and indexed by band, so only chunks sharing a band
+    with the new one are compared (LSH). The containment of a new chunk in a
+    kept one, the share of its shingles the kept chunk has, is estimated from
+    their Jaccard similarity and shingle counts, so an abstract is found in
+    the longer chunk of the full text that starts with it. A chunk whose
+    containment reaches `threshold` is dropped and linked to that chunk in
+    `duplicates`. Only kept chunks are indexed.
+
+    The other way round, kept chunks contained in a new chunk of another
+    document are recorded as superseded, so a document seen first (an
+    abstract loaded earlier) whose chunks are all in a later one (its full
+    text) is listed by `superseded_dockeys` for removal.
+    """
+
+    # short bands, so chunks with a low Jaccard similarity but a high
+    # containment still share one
+    def __init__(self, threshold=0.8, num_perm=128, bands=64, shingle_words=5, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_words = shingle_words
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.band_index = [defaultdict(list) for _ in range(bands)]
+        self.signatures = []
+        self.sizes = []
+        self.sources = []
+        self.dockeys = []
+        # dockey -> number of its indexed chunks, and those superseded
+        self.indexed = defaultdict(int)
+        self.superseded = defaultdict(set)
+        self.duplicates = []
+        self.trimmed = set()
+        self.skipped_files = set()
+        self.chunks = 0
+        self.chars = 0
+        self.dropped_chars = 0
+
+    def signature(self, text):
+        """(MinHash signature, number of shingles) of `text`."""
+        hashes = np.fromiter(shingles(text, self.shingle_words), dtype=np.uint64)
+        # the products wrap around 2**64, as in the usual MinHash implementations
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME
+        return (permuted & MAX_HASH).min(axis=0).astype(np.uint32), len(hashes)
+
+    def _bands(self, signature):
+        return [
+            signature[i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+    def find(self, signature, size):
+        """Return (source, containment) of the indexed chunk containing most of a
+        chunk with `size` shingles, if it reaches the threshold, and the ids of
+        the indexed chunks that chunk contains."""
+        candidates = set()
+        for band, key in zip(self.band_index, self._bands(signature)):
+            candidates.update(band.get(key, ()))
+        best = None
+        contained = []
+        for i in candidates:
+            jaccard = float(np.mean(self.signatures[i] == signature))
+            # |A & B| = J (|A| + |B|) / (1 + J)
+            common = jaccard * (size + self.sizes[i]) / (1 + jaccard)
+            containment = min(1.0, common / size)
+            if containment >= self.threshold and (best is None or containment > best[1]):
+                best = (self.sources[i], containment)
+            if common / self.sizes[i] >= self.threshold:
+                contained.append(i)
+        return best, contained
+
+    def add(self, source, signature, size, dockey=None):
+        i = len(self.signatures)
+        self.signatures.append(signature)
+        self.sizes.append(size)
+        self.sources.append(source)
+        self.dockeys.append(dockey)
+        self.indexed[dockey] += 1
+        for band, key in zip(self.band_index, self._bands(signature)):
+            band[key].append(i)
+
+    def seed(self, texts, deleted_dockeys=()):
+        """Index the chunks of an existing library, so new papers are checked against
+        them. Chunks of documents in `deleted_dockeys` are left out."""
+        for t in texts:
+            if t.doc.dockey not in deleted_dockeys:
+                self.add((t.doc.docname, t.name), *self.signature(t.text), t.doc.dockey)
+
+    def keep(self, f, texts):
+        """Indices of the chunks of file `f` that are not near duplicates."""
+        kept = []
+        for i, t in enumerate(texts):
+            signature, size = self.signature(t.text)
+            self.chunks += 1
+            self.chars += len(t.text)
+            match, contained = self.find(signature, size)
+            if match is None:
+                dockey = t.doc.dockey
+                for j in contained:
+                    if self.dockeys[j] is not None and self.dockeys[j] != dockey:
+                        self.superseded[self.dockeys[j]].add(j)
+                self.add((f, t.name), signature, size, dockey)
+                kept.append(i)
+                continue
+            self.dropped_chars += len(t.text)
+            self.duplicates.append(
+                {"file": f, "chunk": t.name, "duplicate_of": list(match[0]), "containment": match[1]}
+            )
+        if len(kept) < len(texts):
+            self.trimmed.add(f)
+            if not kept:
+                self.skipped_files.add(f)
+        return kept
+
+    def superseded_dockeys(self):
+        """Documents all of whose chunks are contained in chunks of later documents."""
+        return {
+            dockey
+            for dockey, chunks in self.superseded.items()
+            if len(chunks) == self.indexed[dockey]
+        }
+
+    def filter(self, f, texts):
+        return [texts[i] for i in self.keep(f, texts)]
+
+    def report(self):
+        return {
+            "chunks": self.chunks,
+            "dropped_chunks": len(self.duplicates),
+            "dropped_fraction": len(self.duplicates) / max(self.chunks, 1),
+            "chars": self.chars,
+            "dropped_chars": self.dropped_chars,
+            "trimmed_files": len(self.trimmed),
+            "skipped_files": len(self.skipped_files),
+            "superseded_papers": len(self.superseded_dockeys()),
+        }
+
+    def print_report(self):
+        report = self.report()
+        report["dropped_percent"] = 100 * report["dropped_fraction"]
+        print(
+            "Near-duplicate chunks: %(dropped_chunks)d of %(chunks)d dropped "
+            "(%(dropped_percent).1f%%, %(dropped_chars)d characters not embedded), "
+            "%(skipped_files)d papers skipped as full duplicates, "
+            "%(trimmed_files)d papers with duplicate chunks, "
+            "%(superseded_papers)d earlier papers contained in later ones"
+            % report
+        )
@@ -0,0 +1,212 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import numpy as np
+
+
+def _split_cpus(cpus, workers):
+    """Split a list of CPU ids into `workers` contiguous groups, or None when
+    there are fewer CPUs than workers."""
+    cpus = sorted(cpus)
+    if len(cpus) < workers:
+        return None
+    size, extra = divmod(len(cpus), workers)
+    groups = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+def _worker(name, backend, threads, cpus, conn):
+    from .cpu_backend import set_cpu_threads
+    from .embedding import embed_texts, get_embedding_model
+
+    set_cpu_threads(threads, cpus)
+    model = get_embedding_model(name, backend=backend)
+    conn.send((None, None, None))
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        shard, texts, batch_size = task
+        try:
+            vectors = np.asarray(embed_texts(model, texts, batch_size), dtype=np.float32)
+            conn.send((shard, vectors, None))
+        except Exception as exception:
+            # exceptions of the model may not pickle, so only the message is sent
+            conn.send((shard, None, "%s: %s" % (type(exception).__name__, exception)))
+
+
+class EmbeddingWorkerPool:
+    """Embeds chunks with `workers` processes, each holding its own copy of the model.
+
+    On hosts with many cores, several model replicas running a few threads
+    each keep more cores busy than one replica with many threads. Each worker
+    is pinned to its own share of the CPUs this process may run on and runs
+    `threads` threads (its share of the CPUs by default). Texts are sorted by
+    length and cut into shards of one batch, which are handed to idle workers;
+    vectors are merged back in input order. When a worker dies, its shard is
+    queued again and the worker is replaced; a shard that kills workers more
+    than `max_retries` times raises RuntimeError.
+
+    The pool can be passed as the embedding model of `embedding.embed_files`
+    and `embedding.embed_file_list`. Workers start on first use and stop with
+    `close`.
+    """
+
+    def __init__(self, name, workers=2, threads=None, backend="torch", batch_size=64, max_retries=2):
+        self.model_name = name
+        # read by cache.embeddings_name, as the marker of quantized models
+        self.qatool_backend = None if backend == "torch" else backend
+        self.backend = backend
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.cpus = _split_cpus(os.sched_getaffinity(0), workers)
+        if threads is None:
+            threads = max(1, len(os.sched_getaffinity(0)) // workers)
+        self.threads = threads
+        self.context = multiprocessing.get_context("spawn")
+        # every worker has its own pipe, so one dying while it writes a result
+        # cannot block the others
+        self.processes = {}
+        self.conns = {}
+        # worker id -> (call, shard) it is embedding, None while idle, missing while loading
+        self.running = {}
+        self.calls = 0
+        self.restarts = 0
+        self.load_failures = 0
+
+    def _start(self, worker_id):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=_worker,
+            args=(
+                self.model_name,
+                self.backend,
+                self.threads,
+                None if self.cpus is None else self.cpus[worker_id],
+                child_conn,
+            ),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self.processes[worker_id] = process
+        self.conns[worker_id] = conn
+
+    def start(self):
+        if not self.processes:
+            for worker_id in range(self.workers):
+                self._start(worker_id)
+
+    def embed_sharded(self, texts, batch_size=None):
+        """Embed `texts` across the workers and return vectors in input order."""
+        if not texts:
+            return []
+        self.start()
+        self.calls += 1
+        call = self.calls
+        batch_size = batch_size or self.batch_size
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        shards = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        todo = list(range(len(shards)))
+        todo.reverse()
+        retries = [0] * len(shards)
+        vectors = [None] * len(texts)
+        done = 0
+        while done < len(shards):
+            for worker_id, task in self.running.items():
+                if task is None and todo:
+                    shard = todo.pop()
+                    self.running[worker_id] = (call, shard)
+                    try:
+                        self.conns[worker_id].send(
+                            ((call, shard), [texts[i] for i in shards[shard]], batch_size)
+                        )
+                    except (BrokenPipeError, ConnectionResetError):
+                        # died while idle; replaced below and the shard queued again
+                        pass
+            workers = {conn: worker_id for worker_id, conn in self.conns.items()}
+            workers.update({p.sentinel: worker_id for worker_id, p in self.processes.items()})
+            for ready in multiprocessing.connection.wait(list(workers)):
+                worker_id = workers[ready]
+                if ready is not self.conns[worker_id]:
+                    continue
+                try:
+                    task, shard_vectors, error = ready.recv()
+                except EOFError:
+                    # died, replaced below
+                    continue
+                # None when the model is loaded and the worker is ready for shards
+                self.running[worker_id] = None
+                if task is None or task[0] != call:
+                    # left over from an earlier call that failed
+                    continue
+                shard = task[1]
+                if error is not None:
+                    raise RuntimeError("Embedding worker %d failed: %s" % (worker_id, error))
+                for i, vector in zip(shards[shard], shard_vectors):
+                    vectors[i] = vector.tolist()
+                done += 1
+            self._replace_dead(call, todo, retries)
+        return vectors
+
+    def _replace_dead(self, call, todo, retries):
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if worker_id not in self.running:
+                self.load_failures += 1
+                if self.load_failures > self.max_retries:
+                    raise RuntimeError(
+                        "Embedding workers failed to load %s, exit code %s."
+                        % (self.model_name, process.exitcode)
+                    )
+            task = self.running.pop(worker_id, None)
+            if task is not None and task[0] == call:
+                shard = task[1]
+                retries[shard] += 1
+                if retries[shard] > self.max_retries:
+                    raise RuntimeError(
+                        "Embedding workers crashed %d times on the same chunks." % retries[shard]
+                    )
+                todo.append(shard)
+            print(
+                "Embedding worker %d exited with code %s, restarting it."
+                % (worker_id, process.exitcode)
+            )
+            self.conns[worker_id].close()
+            self.restarts += 1
+            self._start(worker_id)
+
+    def embed_documents(self, texts):
+        return self.embed_sharded(texts)
+
+    def embed_query(self, text):
+        return self.embed_sharded([text])[0]
+
+    def close(self):
+        for worker_id, process in self.processes.items():
+            if process.is_alive():
+                try:
+                    self.conns[worker_id].send(None)
+                except OSError:
+                    pass
+        for worker_id, process in self.processes.items():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+            self.conns[worker_id].close()
+        self.processes = {}
+        self.conns = {}
+        self.running = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,315 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from paperqa.utils import md5sum
+from .cache import embeddings_name
+from .parse import EXTRACT_VERSION, parse_files
+from .trace import NullTracer
+
+
+def _load_embedding_model(embeddings, device=None, backend="torch"):
+    if backend == "int8":
+        from .cpu_backend import quantize_model
+
+        if device not in (None, "cpu"):
+            raise ValueError("The int8 backend only runs on CPU.")
+        return quantize_model(_load_embedding_model(embeddings, device))
+    if embeddings in ["hkunlp/instructor-large", "hkunlp/instructor-xl"]:
+        from langchain.embeddings import HuggingFaceInstructEmbeddings
+
+        model_kwargs = {"device": device or "cpu"}
+        encode_kwargs = {"normalize_embeddings": True}
+        return HuggingFaceInstructEmbeddings(
+            model_name=embeddings,
+            model_kwargs=model_kwargs,
+            encode_kwargs=encode_kwargs,
+        )
+    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+
+    if device is None:
+        return HuggingFaceEmbeddings(model_name=embeddings)
+    return HuggingFaceEmbeddings(model_name=embeddings, model_kwargs={"device": device})
+
+
+class EmbeddingModelRegistry:
+    """Process-wide cache of loaded embedding models.
+
+    Models are keyed by (name, device, backend) and shared by every caller, so only the
+    first request for a model pays for loading it. At most `max_models` stay
+    resident; the least recently used one is dropped when another is loaded.
+    Concurrent requests for the same model wait for a single load.
+    """
+
+    def __init__(self, max_models=2):
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.hits = 0
+        self.load_seconds = {}
+
+    def get(self, name, device=None, backend="torch"):
+        key = (name, device, backend)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return self.models[key]
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.models:
+                    self.hits += 1
+                    return self.models[key]
+            start = time.perf_counter()
+            model = _load_embedding_model(name, device, backend)
+            with self.lock:
+                self.load_seconds.setdefault(key, []).append(time.perf_counter() - start)
+                self.models[key] = model
+                while len(self.models) > self.max_models:
+                    self.models.popitem(last=False)
+            return model
+
+    def register(self, name, model, device=None, backend="torch"):
+        """Make an already built model available under `name`."""
+        with self.lock:
+            self.models[(name, device, backend)] = model
+            self.models.move_to_end((name, device, backend))
+
+    def preload(self, names, device=None, backend="torch"):
+        for name in names:
+            self.get(name, device, backend)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "resident": [
+                    "%s (%s, %s)" % (name, device or "default", backend)
+                    for name, device, backend in self.models
+                ],
+                "hits": self.hits,
+                "loads": sum(len(times) for times in self.load_seconds.values()),
+                "load_seconds": {
+                    "%s (%s, %s)" % (name, device or "default", backend): sum(times)
+                    for (name, device, backend), times in self.load_seconds.items()
+                },
+            }
+
+
+model_registry = EmbeddingModelRegistry()
+
+
+def get_embedding_model(embeddings, device=None, backend="torch"):
+    return model_registry.get(embeddings, device, backend)
+
+
+def _encode(embeddings, texts, batch_size):
+    # embed_documents of the langchain HuggingFace models encodes with the
+    # default batch size of sentence-transformers, so call the model directly,
+    # preparing the texts as embed_documents does
+    if hasattr(embeddings, "embed_instruction"):
+        inputs = [[embeddings.embed_instruction, text] for text in texts]
+    else:
+        inputs = [text.replace("\n", " ") for text in texts]
+    encode_kwargs = dict(getattr(embeddings, "encode_kwargs", None) or {}, batch_size=batch_size)
+    return embeddings.client.encode(inputs, **encode_kwargs).tolist()
+
+
+def embed_texts(embeddings, texts, batch_size=64):
+    """Embed strings in batches of `batch_size` and return vectors in input order.
+
+    Local sentence-transformers models get all texts at once and batch them
+    themselves, sorted by length so little of each forward pass is spent on
+    padding. An `embed_pool.EmbeddingWorkerPool` spreads the batches over its
+    processes.
+    """
+    embed_sharded = getattr(embeddings, "embed_sharded", None)
+    if embed_sharded is not None:
+        return embed_sharded(texts, batch_size)
+    if not texts:
+        return []
+    if hasattr(getattr(embeddings, "client", None), "encode"):
+        return _encode(embeddings, texts, batch_size)
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        vectors.extend(embeddings.embed_documents(texts[start : start + batch_size]))
+    return vectors
+
+
+def _embed_group(embeddings, group, batch_size, tracer):
+    texts = [t.text for _, chunks, _ in group for t in chunks]
+    start = time.time()
+    try:
+        vectors = embed_texts(embeddings, texts, batch_size)
+    except Exception:
+        # embed file by file so one bad file does not fail the whole group
+        for f, chunks, exception in group:
+            try:
+                with tracer.span("embed", file=f, count=len(chunks)):
+                    file_vectors = embed_texts(embeddings, [t.text for t in chunks], batch_size)
+                yield f, chunks, file_vectors, exception
+            except Exception as exception:
+                yield f, [], [], exception
+        return
+    # share the group's embedding time between its files by chunk count
+    seconds = (time.time() - start) / max(len(texts), 1)
+    vectors = iter(vectors)
+    for f, chunks, exception in group:
+        tracer.add("embed", start, seconds * len(chunks), file=f, count=len(chunks))
+        start += seconds * len(chunks)
+        yield f, chunks, [next(vectors) for _ in chunks], exception
+
+
+def embed_files(parsed, embeddings, batch_size=64, bucket_batches=8, tracer=None):
+    """Embed chunks from many files together, in fixed-size batches.
+
+    `parsed` yields (file, texts, exception) as returned by
+    `parse.parse_files`. Files are buffered until about `bucket_batches`
+    batches of chunks are pending, embedded together, and yielded back as
+    (file, texts, vectors, exception) in their original order. A group is
+    embedded in the background while the previous one is yielded, and with an
+    `embed_pool.EmbeddingWorkerPool` it holds at least two batches per worker.
+    """
+    if tracer is None:
+        tracer = NullTracer()
+    bucket_batches = max(bucket_batches, 2 * getattr(embeddings, "workers", 1))
+
+    def groups():
+        group = []
+        pending = 0
+        for f, texts, exception in parsed:
+            group.append((f, texts, exception))
+            pending += len(texts)
+            if pending >= batch_size * bucket_batches:
+                yield group
+                group = []
+                pending = 0
+        if group:
+            yield group
+
+    def embed_group(group):
+        return list(_embed_group(embeddings, group, batch_size, tracer))
+
+    # one group at a time, so the model or pool is never called concurrently
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed") as executor:
+        running = None
+        for group in groups():
+            future = executor.submit(embed_group, group)
+            if running is not None:
+                yield from running.result()
+            running = future
+        if running is not None:
+            yield from running.result()
+
+
+def _dedup_parsed(parsed, dedup, tracer):
+    for f, texts, exception in parsed:
+        if exception is None:
+            with tracer.span("dedup", file=f, count=len(texts)):
+                texts = dedup.filter(f, texts)
+        yield f, texts, exception
+
+
+def embed_file_list(
+    file_list,
+    embeddings,
+    chunk_chars=3000,
+    workers=1,
+    batch_size=64,
+    cache=None,
+    tracer=None,
+    dedup=None,
+    text_cache=None,
+    dockeys=None,
+):
+    """Parse and embed `file_list`, yielding (file, texts, vectors, exception).
+
+    Files found in `cache` skip parsing and embedding; the rest go through
+    `parse.parse_files` and `embed_files` and are added to the cache. Results
+    keep the order of `file_list` either way. With a `dedup.ChunkDeduplicator`,
+    near-duplicate chunks are dropped before they are embedded. `text_cache`
+    is the directory of the extracted text cache used by `parse.read_file`.
+    Files are hashed once, unless their `dockeys` are given.
+    """
+    if tracer is None:
+        tracer = NullTracer()
+    if cache is None:
+        parsed = parse_files(
+            file_list,
+            chunk_chars=chunk_chars,
+            workers=workers,
+            tracer=tracer,
+            text_cache=text_cache,
+            dockeys=dockeys,
+        )
+        if dedup is not None:
+            parsed = _dedup_parsed(parsed, dedup, tracer)
+        yield from embed_files(parsed, embeddings, batch_size=batch_size, tracer=tracer)
+        return
+    # chunks of an older extract_file are not reused
+    model = "%s:extract%d" % (embeddings_name(embeddings), EXTRACT_VERSION)
+    if dockeys is None:
+        dockeys = []
+        for f in file_list:
+            try:
+                with tracer.span("hash", file=f):
+                    dockeys.append(md5sum(f))
+            except OSError:
+                dockeys.append(None)
+    with tracer.span("cache", count=len(file_list)):
+        cached = [
+            dockey is not None and cache.contains(dockey, model, chunk_chars)
+            for dockey in dockeys
+        ]
+    missing = [(f, dockey) for f, dockey, hit in zip(file_list, dockeys, cached) if not hit]
+    parsed = parse_files(
+        [f for f, _ in missing],
+        chunk_chars=chunk_chars,
+        workers=workers,
+        tracer=tracer,
+        text_cache=text_cache,
+        dockeys=[dockey for _, dockey in missing],
+    )
+    if dedup is not None:
+        parsed = _dedup_parsed(parsed, dedup, tracer)
+    computed = embed_files(parsed, embeddings, batch_size=batch_size, tracer=tracer)
+    for f, dockey, hit in zip(file_list, dockeys, cached):
+        if hit:
+            with tracer.span("cache", file=f):
+                entry = cache.get(dockey, model, chunk_chars)
+            if entry is not None:
+                texts, vectors = entry
+                if dedup is not None:
+                    with tracer.span("dedup", file=f, count=len(texts)):
+                        kept = dedup.keep(f, texts)
+                    texts = [texts[i] for i in kept]
+                    vectors = [vectors[i] for i in kept]
+                yield f, texts, vectors, None
+                continue
+            # evicted since the lookup above, compute it on its own
+            single = parse_files(
+                [f], chunk_chars, tracer=tracer, text_cache=text_cache, dockeys=[dockey]
+            )
+            if dedup is not None:
+                single = _dedup_parsed(single, dedup, tracer)
+            results = embed_files(
+                single,
+                embeddings,
+                batch_size,
+                tracer=tracer,
+            )
+        else:
+            cache.misses += 1
+            results = [next(computed)]
+        for f, texts, vectors, exception in results:
+            # files missing deduplicated chunks are not cached incomplete
+            trimmed = dedup is not None and f in dedup.trimmed
+            if exception is None and dockey is not None and not trimmed:
+                with tracer.span("cache", file=f, count=len(texts)):
+                    cache.put(dockey, model, chunk_chars, texts, vectors)
+            yield f, texts, vectors, exception
@@ -0,0 +1,138 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain.vectorstores.base import VectorStore
+from .cache import embeddings_name
+from .library import load_library
+from .vectorstore import MatrixVectorStore
+
+# shard holding texts added to a federated library after loading
+ADDED_SHARD = "(added)"
+
+
+class FederatedVectorStore(VectorStore):
+    """Searches the texts indexes of several libraries as one.
+
+    The question is embedded once and every shard is searched in parallel for
+    its nearest chunks. The candidates are merged by distance, so all shards
+    must use the same embedding model. `search` returns the time each shard
+    took along with the results; through the VectorStore methods, the times
+    of the last search made by the calling thread are given by `latencies`.
+    Texts added after loading are kept in memory as one more shard. `close`
+    stops the search threads.
+    """
+
+    def __init__(self, shards, embedding):
+        self.shards = shards
+        self.embedding = embedding
+        self.executor = ThreadPoolExecutor(max_workers=len(shards))
+        # questions are answered on several threads, each reading its own times
+        self.local = threading.local()
+
+    def _search_shard(self, name, embedding, k):
+        start = time.perf_counter()
+        results = self.shards[name].similarity_search_with_score_by_vector(embedding, k=k)
+        return name, results, time.perf_counter() - start
+
+    def search(self, embedding, k):
+        """(the `k` nearest (document, distance) pairs, seconds per shard)."""
+        try:
+            futures = [
+                self.executor.submit(self._search_shard, name, embedding, k)
+                for name in self.shards
+            ]
+            shard_results = [future.result() for future in futures]
+        except RuntimeError:
+            # closed while a question was still being answered
+            shard_results = [self._search_shard(name, embedding, k) for name in self.shards]
+        candidates = []
+        latencies = {}
+        for name, results, seconds in shard_results:
+            latencies[name] = seconds
+            candidates.extend(results)
+        candidates.sort(key=lambda result: result[1])
+        return candidates[:k], latencies
+
+    def latencies(self):
+        return getattr(self.local, "latencies", {})
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        candidates, self.local.latencies = self.search(embedding, k)
+        return candidates
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [
+            document
+            for document, _ in self.similarity_search_with_score_by_vector(embedding, k)
+        ]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, **kwargs):
+        # candidates from different shards are only comparable by score
+        return self.similarity_search(query, k)
+
+    def add_embeddings(self, text_embeddings, metadatas=None, **kwargs):
+        if ADDED_SHARD not in self.shards:
+            self.shards[ADDED_SHARD] = MatrixVectorStore.from_texts([], self.embedding)
+        return self.shards[ADDED_SHARD].add_embeddings(text_embeddings, metadatas)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        vectors = self.embedding.embed_documents(texts)
+        return self.add_embeddings(zip(texts, vectors), metadatas)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        return cls({ADDED_SHARD: MatrixVectorStore.from_texts(texts, embedding, metadatas)}, embedding)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def _load_shard(lib_name, index, shared_dir=None):
+    docs = load_library(lib_name, lazy=True, index=index, shared_dir=shared_dir)
+    if not hasattr(docs.texts_index, "lookup"):
+        # every pickled library saves its FAISS index to the same default
+        # path, so rebuild the one for this library from its own texts
+        docs.texts_index = None
+        docs._build_texts_index()
+    return docs
+
+
+def load_federated(lib_names, index="flat", shared_dir=None):
+    """Load several libraries in parallel and combine them into one Docs.
+
+    The returned Docs is a new one holding the documents of every library,
+    and searches all of them through a FederatedVectorStore, which should be
+    closed when the Docs is no longer used.
+    """
+    with ThreadPoolExecutor(max_workers=len(lib_names)) as executor:
+        shards = dict(
+            zip(lib_names, executor.map(lambda name: _load_shard(name, index, shared_dir), lib_names))
+        )
+    names = {embeddings_name(docs.embeddings) for docs in shards.values()}
+    if len(names) > 1:
+        raise ValueError(
+            "Libraries use different embedding models (%s) and cannot be searched together."
+            % ", ".join(sorted(names))
+        )
+    from paperqa import Docs
+
+    first = shards[lib_names[0]]
+    docs = Docs(llm=first.llm, embeddings=first.embeddings)
+    docs.summary_llm = first.summary_llm
+    for shard in shards.values():
+        docs.docs.update(shard.docs)
+        docs.docnames.update(shard.docnames)
+        docs.deleted_dockeys.update(shard.deleted_dockeys)
+    docs.texts_index = FederatedVectorStore(
+        {lib_name: shard.texts_index for lib_name, shard in shards.items()},
+        docs.embeddings,
+    )
+    return docs
@@ -0,0 +1,193 @@
+import argparse
+import re
+
+BLOCK_TAGS = {
+    "h1", "h2", "h3", "h4", "h5", "h6", "p", "li", "dt", "dd", "tr",
+    "caption", "figcaption", "blockquote", "pre", "div", "section",
+}
+LEAF_TAGS = BLOCK_TAGS - {"div", "section"}
+DROP_TAGS = [
+    "script", "style", "noscript", "nav", "footer", "aside", "form",
+    "button", "select", "iframe", "svg", "canvas", "template",
+]
+# class or id tokens of navigation, menus, sharing widgets and reference lists;
+# a token must match as a whole, so "container with-sidebar" is kept
+BOILERPLATE = re.compile(
+    r"(site[-_])?(nav|navbar|nav[-_]bar|menu|breadcrumbs?|sidebar|footer|masthead|"
+    r"banner|cookies?|cookie[-_]banner|share|social|skip[-_]link|toolbar|ref[-_]list|"
+    r"references?|citation[-_]list|related|recommended|advert|ads?|metrics|altmetric)",
+    re.IGNORECASE,
+)
+REFERENCE_HEADINGS = re.compile(
+    r"^\s*(\d+\.?\s*)?(references|bibliography|literature cited|works cited|footnotes|"
+    r"acknowledge?ments?|funding|conflicts? of interest|author contributions|"
+    r"associated data|supplementary (material|data))\s*$",
+    re.IGNORECASE,
+)
+MAIN_XPATH = (
+    "//article | //main | //*[@role='main'] | //*[@id='maincontent'] | "
+    "//*[@id='main-content'] | //*[contains(concat(' ', @class, ' '), ' article ')]"
+)
+
+
+def _clean(text):
+    return " ".join(text.split())
+
+
+def _drop(el):
+    if el.getparent() is not None:
+        el.drop_tree()
+
+
+def _is_boilerplate(el):
+    tokens = el.get("class", "").split() + el.get("id", "").split()
+    return any(BOILERPLATE.fullmatch(token) for token in tokens)
+
+
+def _main_element(root):
+    candidates = root.xpath(MAIN_XPATH)
+    if not candidates:
+        body = root.find("body")
+        return root if body is None else body
+    return max(candidates, key=lambda el: len(el.text_content()))
+
+
+def _flush(items, pending):
+    text = _clean("".join(pending))
+    if text:
+        items.append((None, text))
+    pending.clear()
+
+
+def _collect(el, items, pending):
+    """Append the paragraphs under `el` to `items` as (leaf tag, element) or
+    (None, text); inline text gathers in `pending` until a block or `br` ends it."""
+    if el.text:
+        pending.append(el.text)
+    for child in el:
+        if child.tag == "br":
+            _flush(items, pending)
+        elif child.tag in LEAF_TAGS:
+            _flush(items, pending)
+            items.append((child.tag, child))
+        elif child.tag in BLOCK_TAGS:
+            # a container's own text and the tails of its children are
+            # paragraphs between those of its child blocks
+            _flush(items, pending)
+            _collect(child, items, pending)
+            _flush(items, pending)
+        else:
+            _collect(child, items, pending)
+        if child.tail:
+            pending.append(child.tail)
+
+
+def html_to_text(raw):
+    """Article text of an HTML page, without navigation, scripts or references.
+
+    Parses with lxml, keeps the main article element when the page marks one,
+    and writes headings as markdown headings and every paragraph, list item
+    and table row as its own paragraph. Text directly inside containers, or
+    separated by line breaks, makes paragraphs of its own. Sections titled References,
+    Acknowledgements and the like are left out.
+    """
+    import lxml.html
+    from lxml.etree import ParserError
+
+    if isinstance(raw, str):
+        # lxml rejects str input that carries an encoding declaration
+        raw = raw.encode("utf-8")
+    try:
+        root = lxml.html.document_fromstring(
+            raw, parser=lxml.html.HTMLParser(encoding="utf-8")
+        )
+    except (ParserError, ValueError):
+        return ""
+    for el in root.xpath("//comment() | //processing-instruction()"):
+        _drop(el)
+    # site headers, but not the header of the article with its title
+    for el in list(root.iter(*DROP_TAGS)) + root.xpath("//header[not(ancestor::article)]"):
+        _drop(el)
+    for el in root.xpath("//*[@class or @id]"):
+        if _is_boilerplate(el):
+            _drop(el)
+    # words on either side of a line break stay apart
+    for el in root.iter("br"):
+        el.tail = "\n" + (el.tail or "")
+    items = []
+    pending = []
+    _collect(_main_element(root), items, pending)
+    _flush(items, pending)
+    blocks = []
+    skip_level = None
+    for tag, el in items:
+        if tag is None:
+            text = el
+        elif tag == "tr":
+            text = " | ".join(_clean(cell.text_content()) for cell in el.iter("td", "th"))
+        else:
+            text = _clean(el.text_content())
+        if not text:
+            continue
+        if tag is not None and tag[0] == "h" and tag[1:].isdigit():
+            level = int(tag[1:])
+            if skip_level is not None and level > skip_level:
+                continue
+            skip_level = level if REFERENCE_HEADINGS.match(text) else None
+            if skip_level is None:
+                blocks.append("#" * level + " " + text)
+            continue
+        if skip_level is None:
+            blocks.append(text)
+    return "\n\n".join(blocks)
+
+
+def compare_corpus(doc_dir, chunk_chars=3000):
+    """Chunks and characters of the HTML files in `doc_dir` with html2text and with
+    `html_to_text`."""
+    from html2text import html2text
+    from paperqa.types import Doc
+    from .parse import _read_text, chunk_extracted, list_files
+
+    doc = Doc(docname="", citation="", dockey="")
+    report = {"files": 0, "html2text_chunks": 0, "lxml_chunks": 0, "html2text_chars": 0, "lxml_chars": 0}
+    for f in list_files(doc_dir):
+        if not f.endswith(".html"):
+            continue
+        raw = _read_text(f)
+        for name, text in (("html2text", html2text(raw)), ("lxml", html_to_text(raw))):
+            report[name + "_chunks"] += len(chunk_extracted(("text", text), doc, chunk_chars))
+            report[name + "_chars"] += len(text)
+        report["files"] += 1
+    return report
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("doc_dir", type=str, help="Directory of downloaded papers.")
+    parser.add_argument(
+        "--chunk_chars",
+        type=int,
+        default=3000,
+        help="Size of the chunks papers are split into. Default value 3000.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_arguments()
+    report = compare_corpus(args.doc_dir, args.chunk_chars)
+    removed = report["html2text_chunks"] - report["lxml_chunks"]
+    print(
+        "%d HTML papers: %d chunks with html2text, %d with boilerplate removed "
+        "(%d fewer, %.1f%%); %d characters instead of %d."
+        % (
+            report["files"],
+            report["html2text_chunks"],
+            report["lxml_chunks"],
+            removed,
+            100 * removed / max(report["html2text_chunks"], 1),
+            report["lxml_chars"],
+            report["html2text_chars"],
+        )
+    )
@@ -0,0 +1,213 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from .ann import INDEX_TYPES, ANNIndex
+from .embed_pool import _split_cpus
+from .library import convert_library, library_path, library_version
+from .quantize import DTYPES
+from .split_library import SplitLibrary
+
+# replaced in this order, vectors before texts and ANN indexes last, so a
+# worker that opens the copy while it is refreshed finds no more rows in
+# SQLite or in an index than in the vectors
+SHARED_EXTS = (".vectors.npy", ".scales.npy", ".citations.npy", ".sqlite") + tuple(
+    ".%s.faiss" % kind for kind in INDEX_TYPES[1:]
+)
+
+
+def _copy_sqlite(path, target):
+    # a consistent snapshot even if the library is written meanwhile, which a
+    # plain file copy does not give
+    source = sqlite3.connect(path)
+    copy = sqlite3.connect(target)
+    try:
+        source.backup(copy)
+    finally:
+        copy.close()
+        source.close()
+
+
+def prepare_library(lib_name, shared_dir=None, dtype="float32"):
+    """Make sure `lib_name` has a split copy with `dtype` vectors, which
+    workers map instead of unpickling, and copy its files to `shared_dir` if
+    given. Its ANN indexes are brought up to date first, since workers map
+    the shared copies read-only.
+
+    Returns the number of bytes of vectors and texts the workers share.
+    """
+    split = SplitLibrary(lib_name)
+    if not split.exists():
+        print("Converting %s to the split format, so workers can share it." % lib_name)
+        convert_library(lib_name, dtype)
+    for kind in INDEX_TYPES[1:] if shared_dir else []:
+        index = ANNIndex(lib_name, kind)
+        if index.exists() and index.load().update(split.vectors()):
+            index.save()
+    size = 0
+    copied = []
+    for ext in SHARED_EXTS:
+        path = library_path(lib_name, ext)
+        if not os.path.exists(path):
+            continue
+        size += os.path.getsize(path)
+        if shared_dir:
+            target = os.path.join(shared_dir, lib_name + ext)
+            if ext == ".sqlite":
+                _copy_sqlite(path, target + ".tmp")
+            else:
+                shutil.copyfile(path, target + ".tmp")
+            copied.append(target)
+    # only replaced once every file is copied
+    for target in copied:
+        os.replace(target + ".tmp", target)
+    return size
+
+
+def remove_shared(lib_names, shared_dir):
+    for lib_name in lib_names:
+        for ext in SHARED_EXTS:
+            path = os.path.join(shared_dir, lib_name + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def worker_command(lib_names, port, shared_dir=None, cpus=None, qa_args=()):
+    command = [sys.executable, "-m", "qatool.qa", "--web", "--lib_name", *lib_names]
+    command += ["--port", str(port)]
+    if shared_dir:
+        command += ["--shared_dir", shared_dir]
+    if cpus is not None:
+        command += ["--cpu_affinity", ",".join(str(cpu) for cpu in cpus)]
+    return command + list(qa_args)
+
+
+def launch(
+    lib_names,
+    port=8000,
+    processes=2,
+    shared_dir=None,
+    pin=False,
+    qa_args=(),
+    startup_seconds=60,
+    dtype="float32",
+):
+    """Serve `lib_names` with `processes` webpage QA tools on consecutive ports.
+
+    Every worker maps the same split library files read-only, so the vectors
+    and texts are in memory once whatever the number of workers. With
+    `shared_dir` (e.g. /dev/shm/qatool), the files are copied there first and
+    stay in memory even when the page cache is short; they are copied again
+    when papers are added to a library, for the workers to reload. Workers
+    that exit are started again, unless they exit within `startup_seconds` of
+    starting, which stops all of them. With `pin`, each worker runs on its
+    own share of the CPUs. Libraries without a split copy are converted with
+    `dtype` vectors.
+    """
+    if shared_dir:
+        os.makedirs(shared_dir, exist_ok=True)
+    size = sum(prepare_library(lib_name, shared_dir, dtype) for lib_name in lib_names)
+    versions = {lib_name: library_version(lib_name) for lib_name in lib_names}
+    print(
+        "%.1f MB of vectors and texts shared by %d workers%s."
+        % (size / 1024**2, processes, " in %s" % shared_dir if shared_dir else "")
+    )
+    cpus = _split_cpus(os.sched_getaffinity(0), processes) if pin else None
+    commands = [
+        worker_command(
+            lib_names, port + i, shared_dir, None if cpus is None else cpus[i], qa_args
+        )
+        for i in range(processes)
+    ]
+    workers = [subprocess.Popen(command) for command in commands]
+    started = [time.time()] * processes
+    print("Workers listening on ports %s." % ", ".join(str(port + i) for i in range(processes)))
+    try:
+        while True:
+            time.sleep(5)
+            for lib_name in lib_names if shared_dir else []:
+                version = library_version(lib_name)
+                if version != versions[lib_name]:
+                    prepare_library(lib_name, shared_dir, dtype)
+                    versions[lib_name] = version
+            for i, worker in enumerate(workers):
+                if worker.poll() is None:
+                    continue
+                if time.time() - started[i] < startup_seconds:
+                    raise RuntimeError(
+                        "Worker on port %d failed to start, exit code %d."
+                        % (port + i, worker.returncode)
+                    )
+                print(
+                    "Worker on port %d exited with code %d, restarting it."
+                    % (port + i, worker.returncode)
+                )
+                workers[i] = subprocess.Popen(commands[i])
+                started[i] = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+        if shared_dir:
+            remove_shared(lib_names, shared_dir)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Start several webpage QA tools sharing one copy of the library. "
+        "Other options are passed to qatool.qa."
+    )
+    parser.add_argument(
+        "--lib_name", type=str, nargs="+", required=True, help="Libraries to serve."
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="Port of the first worker, the others use the next ports. Default value 8000.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=2,
+        help="Number of webpage QA tool processes. Default value 2.",
+    )
+    parser.add_argument(
+        "--shared_dir",
+        type=str,
+        help="Copy the split libraries to this directory, e.g. /dev/shm/qatool, and serve "
+        "them from there. By default workers map the files in './saved_libs'.",
+    )
+    parser.add_argument(
+        "--pin",
+        action="store_true",
+        help="Run each worker on its own share of the CPUs.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=DTYPES,
+        default="float32",
+        help="How vectors are stored when a library is converted to the split format: "
+        "'float32', 'float16' or 'int8'. Default value 'float32'.",
+    )
+    return parser.parse_known_args()
+
+
+if __name__ == "__main__":
+    args, qa_args = get_arguments()
+    launch(
+        args.lib_name,
+        args.port,
+        args.processes,
+        args.shared_dir,
+        args.pin,
+        qa_args,
+        dtype=args.dtype,
+    )
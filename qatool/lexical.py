@@ -0,0 +1,416 @@
+import argparse
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+from .library import library_path
+from .vectorstore import maximal_marginal_relevance
+
+RETRIEVAL_MODES = ["dense", "prefilter", "fusion"]
+STOPWORDS = set(
+    "a an and are as at be by can do does for from has have how in is it its of on or "
+    "that the their there these this to was were what when which who why will with".split()
+)
+# constant of reciprocal rank fusion, as in Cormack et al.
+RRF_K = 60
+# SQLite path of a BM25Index kept in memory
+MEMORY = ":memory:"
+
+
+def tokenize(text):
+    """Lowercased word tokens of `text` without stopwords.
+
+    Hyphenated names are also indexed joined, so "IL-6" matches "IL6", and
+    words like "p16INK4a" or "mTORC1" are kept whole.
+    """
+    text = text.lower()
+    tokens = [t for t in re.findall(r"[a-z0-9]+", text) if t not in STOPWORDS]
+    tokens.extend(m.replace("-", "") for m in re.findall(r"[a-z0-9]+(?:-[a-z0-9]+)+", text))
+    return tokens
+
+
+class BM25Index:
+    """Inverted index of the chunk texts of a library, ranked with BM25.
+
+    Kept in `<lib>.bm25.sqlite` next to the library. Chunk ids are positions
+    in the library's texts, which are also the row ids of its split copy.
+    Postings are clustered by term, so a query only reads the postings of its
+    own terms. With `lib_name` None, the index is kept in memory instead.
+    """
+
+    def __init__(self, lib_name, k1=1.2, b=0.75):
+        self.lib_name = lib_name
+        self.path = MEMORY if lib_name is None else library_path(lib_name, ".bm25.sqlite")
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self._db = None
+        self._lengths = None
+
+    def exists(self):
+        if self.path == MEMORY:
+            return self._db is not None
+        return os.path.exists(self.path)
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+        return self._db
+
+    def _meta(self, key, default=0):
+        row = self.db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return default if row is None else int(row[0])
+
+    def num_rows(self):
+        if not self.exists():
+            return 0
+        with self.lock:
+            return self._meta("rows")
+
+    def create(self, texts):
+        """Index `texts` (paperqa Texts or strings, in library order) as a new index."""
+        self.close()
+        if self.path != MEMORY and self.exists():
+            os.remove(self.path)
+        self.db.executescript(
+            "CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER);"
+            "CREATE TABLE chunks (id INTEGER PRIMARY KEY, length INTEGER);"
+            "CREATE TABLE postings (term TEXT, chunk INTEGER, tf INTEGER, "
+            "PRIMARY KEY (term, chunk)) WITHOUT ROWID;"
+            "INSERT INTO meta VALUES ('rows', 0), ('length', 0);"
+        )
+        self.append(texts)
+
+    def append(self, texts):
+        """Index texts appended to the library."""
+        with self.lock:
+            rows = self._meta("rows")
+            total = self._meta("length")
+            chunks = []
+            postings = []
+            for i, t in enumerate(texts):
+                counts = Counter(tokenize(t if isinstance(t, str) else t.text))
+                length = sum(counts.values())
+                chunks.append((rows + i, length))
+                postings.extend((term, rows + i, tf) for term, tf in counts.items())
+                total += length
+            self.db.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?)", chunks)
+            self.db.executemany("INSERT OR REPLACE INTO postings VALUES (?, ?, ?)", postings)
+            self.db.executemany(
+                "UPDATE meta SET value=? WHERE key=?",
+                [(rows + len(chunks), "rows"), (total, "length")],
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def lengths(self):
+        with self.lock:
+            rows = self._meta("rows")
+            if self._lengths is None or len(self._lengths) != rows:
+                lengths = np.zeros(rows, dtype=np.float32)
+                for i, length in self.db.execute("SELECT id, length FROM chunks"):
+                    lengths[i] = length
+                self._lengths = lengths
+            return self._lengths
+
+    def search(self, query, k):
+        """Ids and BM25 scores of the `k` best chunks for `query`, best first.
+
+        Only chunks containing a query term are returned, so there may be
+        fewer than `k`.
+        """
+        terms = set(tokenize(query))
+        lengths = self.lengths()
+        if not terms or len(lengths) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        average = max(float(lengths.mean()), 1.0)
+        scores = np.zeros(len(lengths), dtype=np.float32)
+        for term in terms:
+            with self.lock:
+                postings = self.db.execute(
+                    "SELECT chunk, tf FROM postings WHERE term=?", (term,)
+                ).fetchall()
+            if not postings:
+                continue
+            ids, tfs = np.asarray(postings, dtype=np.int64).T
+            # chunks appended since the lengths were read
+            known = ids < len(lengths)
+            ids, tfs = ids[known], tfs[known].astype(np.float32)
+            idf = math.log(1 + (len(lengths) - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * lengths[ids] / average)
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        found = np.flatnonzero(scores)
+        if len(found) > k:
+            found = found[np.argpartition(-scores[found], k)[:k]]
+        order = np.argsort(-scores[found], kind="stable")
+        return found[order], scores[found[order]]
+
+
+def memory_store(docs):
+    """MatrixVectorStore over the texts of a pkl library held in memory.
+
+    Row `i` is the `i`-th text not deleted, matching the ids of `BM25Index`.
+    """
+    from .vectorstore import MatrixVectorStore
+
+    texts = [t for t in docs.texts if t.doc.dockey not in docs.deleted_dockeys]
+    vectors = np.asarray([t.embeddings for t in texts], dtype=np.float32)
+
+    def lookup(ids):
+        return [
+            Document(
+                page_content=texts[i].text,
+                metadata={
+                    "name": texts[i].name,
+                    "doc": {
+                        "docname": texts[i].doc.docname,
+                        "citation": texts[i].doc.citation,
+                        "dockey": texts[i].doc.dockey,
+                    },
+                },
+            )
+            for i in ids
+        ]
+
+    return MatrixVectorStore(vectors, docs.embeddings, lookup)
+
+
+class HybridVectorStore(VectorStore):
+    """Searches a library with its BM25 index and its vectors together.
+
+    With mode "prefilter", the `candidates` best chunks by BM25 are ranked by
+    L2 distance to the question, so only those vectors are read; when fewer
+    chunks share a term with the question, the remaining results come from
+    the dense search. With
+    "fusion", the dense and BM25 rankings are merged by reciprocal rank
+    fusion, and scores are the negated fusion scores, so lower is better as
+    with distances. `dense` is a `vectorstore.MatrixVectorStore`.
+    """
+
+    def __init__(self, dense, lexical, mode="prefilter", candidates=1000):
+        if mode not in RETRIEVAL_MODES[1:]:
+            raise ValueError("Unknown hybrid retrieval mode %s." % mode)
+        self.dense = dense
+        self.lexical = lexical
+        self.mode = mode
+        self.candidates = candidates
+
+    @property
+    def embedding(self):
+        return self.dense.embedding
+
+    @embedding.setter
+    def embedding(self, embedding):
+        self.dense.embedding = embedding
+
+    def search(self, query, embedding, fetch_k):
+        """Ids and scores of the `fetch_k` best chunks for the question `query`
+        embedded as `embedding`, best first."""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.mode == "prefilter":
+            ids, _ = self.lexical.search(query, self.candidates)
+            # chunks indexed since the vectors were opened are not searched yet
+            ids = ids[ids < len(self.dense)]
+            if len(ids) == 0:
+                return self.dense.search(embedding, fetch_k)
+            difference = self.dense.get_vectors(ids.tolist()) - embedding
+            distances = np.einsum("ij,ij->i", difference, difference)
+            order = np.argsort(distances)[:fetch_k]
+            ids, distances = ids[order], distances[order]
+            if len(ids) < fetch_k:
+                # fill the remaining slots with the nearest chunks BM25 did not find
+                dense_ids, dense_distances = self.dense.search(embedding, fetch_k)
+                new = ~np.isin(dense_ids, ids)
+                missing = fetch_k - len(ids)
+                ids = np.concatenate([ids, dense_ids[new][:missing]])
+                distances = np.concatenate([distances, dense_distances[new][:missing]])
+            return ids, distances
+        dense_ids, _ = self.dense.search(embedding, fetch_k)
+        lexical_ids, _ = self.lexical.search(query, fetch_k)
+        lexical_ids = lexical_ids[lexical_ids < len(self.dense)]
+        fused = Counter()
+        for ranking in (dense_ids, lexical_ids):
+            for rank, i in enumerate(ranking.tolist()):
+                fused[i] += 1 / (RRF_K + rank + 1)
+        best = fused.most_common(fetch_k)
+        return (
+            np.asarray([i for i, _ in best], dtype=np.int64),
+            -np.asarray([score for _, score in best], dtype=np.float32),
+        )
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        ids, scores = self.search(query, self.embedding.embed_query(query), k)
+        documents = self.dense.get_documents([int(i) for i in ids])
+        return list(zip(documents, [float(s) for s in scores]))
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        # without the question text only the dense search is possible
+        return self.dense.similarity_search_with_score_by_vector(embedding, k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return self.dense.similarity_search_by_vector(embedding, k)
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        embedding = self.embedding.embed_query(query)
+        ids, _ = self.search(query, embedding, fetch_k)
+        ids = [int(i) for i in ids]
+        if self.mode == "fusion":
+            # MMR ranks by vector similarity alone, which would undo the fusion
+            return self.dense.get_documents(ids[:k])
+        selected = maximal_marginal_relevance(
+            np.asarray(embedding, dtype=np.float32), self.dense.get_vectors(ids), k, lambda_mult
+        )
+        return self.dense.get_documents([ids[i] for i in selected])
+
+    def add_embeddings(self, text_embeddings, metadatas=None, **kwargs):
+        # kept in memory by the dense store; the BM25 index of a saved library
+        # stays as saved, so these are only found by their vectors
+        text_embeddings = list(text_embeddings)
+        if self.lexical.path == MEMORY:
+            self.lexical.append([text for text, _ in text_embeddings])
+        return self.dense.add_embeddings(text_embeddings, metadatas)
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        vectors = self.embedding.embed_documents(texts)
+        return self.add_embeddings(zip(texts, vectors), metadatas)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, mode="prefilter", **kwargs):
+        """Index `texts` in memory, with a BM25 index kept in memory too."""
+        from .vectorstore import MatrixVectorStore
+
+        lexical = BM25Index(None)
+        lexical.create([])
+        store = cls(MatrixVectorStore.from_texts([], embedding), lexical, mode)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def close(self):
+        self.lexical.close()
+        close = getattr(self.dense, "close", None)
+        if close is not None:
+            close()
+
+
+def hybrid_store(docs, lib_name, mode="prefilter", candidates=1000):
+    """HybridVectorStore over a library opened with `library.load_library`."""
+    lexical = BM25Index(lib_name)
+    if not lexical.exists():
+        raise FileNotFoundError(
+            "Library %s has no BM25 index, build it by loading papers into it with --load."
+            % lib_name
+        )
+    dense = docs.texts_index
+    if not hasattr(dense, "get_vectors"):
+        dense = memory_store(docs)
+    return HybridVectorStore(dense, lexical, mode, candidates)
+
+
+def compare_retrieval(lib_name, questions, k=10, candidates=1000):
+    """Latency and overlap with the dense top-k of every retrieval mode.
+
+    For each question, the retrieved chunks of each mode are compared with
+    the dense ones (the share of the dense results also retrieved) and checked for the
+    question's rarest term, the exact-term hits dense retrieval tends to miss.
+    """
+    from .library import load_library
+
+    docs = load_library(lib_name, lazy=True)
+    dense = docs.texts_index if hasattr(docs.texts_index, "get_vectors") else memory_store(docs)
+    lexical = BM25Index(lib_name)
+    stores = {mode: HybridVectorStore(dense, lexical, mode, candidates) for mode in RETRIEVAL_MODES[1:]}
+    report = {mode: {"seconds": [], "overlap": [], "term_hits": []} for mode in RETRIEVAL_MODES}
+    for question in questions:
+        embedding = np.asarray(dense.embedding.embed_query(question), dtype=np.float32)
+        start = time.perf_counter()
+        dense_ids, _ = dense.search(embedding, k)
+        report["dense"]["seconds"].append(time.perf_counter() - start)
+        results = {"dense": dense_ids}
+        for mode, store in stores.items():
+            start = time.perf_counter()
+            results[mode], _ = store.search(question, embedding, k)
+            report[mode]["seconds"].append(time.perf_counter() - start)
+        # the query term in fewest chunks, e.g. a gene name
+        terms = set(tokenize(question))
+        counts = {}
+        for term in terms:
+            counts[term] = lexical.db.execute(
+                "SELECT COUNT(*) FROM postings WHERE term=?", (term,)
+            ).fetchone()[0]
+        rarest = min((t for t in counts if counts[t]), key=counts.get, default=None)
+        for mode, ids in results.items():
+            ids = ids.tolist()
+            report[mode]["overlap"].append(len(set(ids) & set(dense_ids.tolist())) / max(len(dense_ids), 1))
+            if rarest is not None and ids:
+                hits = sum(rarest in tokenize(d.page_content) for d in dense.get_documents(ids))
+                report[mode]["term_hits"].append(hits / len(ids))
+    return {
+        mode: {
+            "mean_ms": 1000 * float(np.mean(values["seconds"])),
+            "p95_ms": 1000 * float(np.percentile(values["seconds"], 95)),
+            "overlap": float(np.mean(values["overlap"])),
+            "term_hits": float(np.mean(values["term_hits"])) if values["term_hits"] else 0.0,
+        }
+        for mode, values in report.items()
+    }
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lib_name", type=str, help="Library to search.")
+    parser.add_argument(
+        "questions_file",
+        type=str,
+        help="Questions, one per line, or JSONL objects with a 'question'.",
+    )
+    parser.add_argument(
+        "--k",
+        type=int,
+        default=10,
+        help="Number of chunks retrieved per question. Default value 10.",
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1000,
+        help="Number of BM25 candidates ranked by vector in prefilter mode. Default value 1000.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from .batch import read_questions
+
+    args = get_arguments()
+    questions = [question for _, question in read_questions(args.questions_file)]
+    report = compare_retrieval(args.lib_name, questions, args.k, args.candidates)
+    print("%d questions, k=%d" % (len(questions), args.k))
+    for mode, values in report.items():
+        print(
+            "%-9s mean %7.1f ms, p95 %7.1f ms, overlap@%d with dense %.3f, "
+            "rarest query term in %.1f%% of chunks"
+            % (
+                mode,
+                values["mean_ms"],
+                values["p95_ms"],
+                args.k,
+                values["overlap"],
+                100 * values["term_hits"],
+            )
+        )
@@ -0,0 +1,299 @@
+import os
+import pickle
+import sqlite3
+import struct
+import zlib
+from itertools import groupby
+
+LIB_DIR = "./saved_libs"
+# Compact once the journal grows past this fraction of the snapshot size, so
+# the cost of rewriting the snapshot is amortized over the papers appended.
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 16 * 1024 * 1024
+
+
+def library_path(lib_name, ext=".pkl"):
+    return os.path.join(LIB_DIR, lib_name + ext)
+
+
+class LibraryJournal:
+    """Append-only log of documents added to a library since its last snapshot.
+
+    Every record is one document and its embedded texts, written as a
+    (length, crc32) header followed by the pickled payload and fsynced before
+    `append` returns. A trailing record torn by a crash fails its checksum and
+    is cut off by `repair`, so committed documents are never lost.
+    """
+
+    header = struct.Struct("<II")
+
+    def __init__(self, path):
+        self.path = path
+
+    def size(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def append(self, doc, texts):
+        payload = pickle.dumps((doc, texts), protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self.path, "ab") as f:
+            f.write(self.header.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _scan(self):
+        with open(self.path, "rb") as f:
+            offset = 0
+            while True:
+                header = f.read(self.header.size)
+                if len(header) < self.header.size:
+                    return
+                length, crc = self.header.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                offset += self.header.size + length
+                yield offset, payload
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return
+        for _, payload in self._scan():
+            yield pickle.loads(payload)
+
+    def repair(self):
+        """Truncate the journal after its last complete record."""
+        if not os.path.exists(self.path):
+            return
+        valid = 0
+        for valid, _ in self._scan():
+            pass
+        if valid < self.size():
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def library_version(lib_name, shared_dir=None):
+    """Fingerprint that changes whenever papers are added to a library.
+
+    With `shared_dir`, of the copy of its split files there.
+    """
+    parts = []
+    for ext in (".pkl", ".journal", ".vectors.npy", ".scales.npy"):
+        if shared_dir:
+            path = os.path.join(shared_dir, lib_name + ext)
+        else:
+            path = library_path(lib_name, ext)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append("%s:%d:%d" % (ext, stat.st_size, stat.st_mtime_ns))
+    return ",".join(parts)
+
+
+def _atomic_dump(obj, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_library(lib_name, lazy=False, index="flat", shared_dir=None, llm=None):
+    """Load the library snapshot and replay any journaled documents onto it.
+
+    With `lazy`, a split copy of the library made by `convert_library` is
+    opened instead when there is one, without reading texts or vectors, and
+    searched with the ANN `index` if one is given. The split files are read
+    from `shared_dir` if given, and `llm` replaces the LLM named in them.
+    """
+    if lazy:
+        from .split_library import SplitLibrary
+
+        split = SplitLibrary(lib_name, shared_dir)
+        if split.exists():
+            return split.load_docs(index=index, llm=llm)
+        if index != "flat":
+            raise FileNotFoundError(
+                "Library %s has no split copy to search with an index." % lib_name
+            )
+    lib_dir = library_path(lib_name)
+    docs = pickle.load(open(lib_dir, "rb"))
+    for doc, texts in LibraryJournal(library_path(lib_name, ".journal")).records():
+        docs.add_texts(texts, doc)
+    return docs
+
+
+def convert_library(lib_name, dtype="float32"):
+    """Write the split, lazily loaded copy of a pkl library.
+
+    Once converted, documents added with `LibraryWriter` are appended to both.
+    ANN indexes built for an earlier split copy are built again.
+    Vectors are stored as `dtype`; for float16 and int8 the recall@10 of
+    searching the stored vectors against the float32 ones is returned.
+    """
+    from .split_library import SplitLibrary
+
+    docs = load_library(lib_name)
+    split = SplitLibrary(lib_name)
+    # ANN indexes of an earlier copy are rebuilt for the new rows
+    rebuild_split(docs, split, dtype)
+    if dtype != "float32":
+        return split.check_quantization(docs)
+    return None
+
+
+def compact_library(docs, lib_name):
+    """Write a fresh snapshot of `docs` and drop the journal it supersedes."""
+    _atomic_dump(docs, library_path(lib_name))
+    LibraryJournal(library_path(lib_name, ".journal")).clear()
+
+
+def remove_documents(docs, lib_name, dockeys):
+    """Remove documents from `docs` and rewrite the library files without them.
+
+    The snapshot is rewritten, and the split copy, its ANN indexes and the
+    BM25 index are rebuilt if the library has them. Returns the number of
+    removed documents.
+    """
+    dockeys = set(dockeys) & set(docs.docs)
+    if not dockeys:
+        return 0
+    for dockey in dockeys:
+        docs.docnames.discard(docs.docs.pop(dockey).docname)
+    docs.texts = [t for t in docs.texts if t.doc.dockey not in dockeys]
+    docs.texts_index = None
+    docs.doc_index = None
+    compact_library(docs, lib_name)
+    from .lexical import BM25Index
+    from .split_library import SplitLibrary
+
+    lexical = BM25Index(lib_name)
+    if lexical.exists():
+        lexical.create([t for t in docs.texts if t.doc.dockey not in docs.deleted_dockeys])
+    split = SplitLibrary(lib_name)
+    if split.exists():
+        rebuild_split(docs, split, split.dtype())
+    return len(dockeys)
+
+
+def rebuild_split(docs, split, dtype):
+    """Write `split` again from `docs`, with `dtype` vectors, and rebuild the
+    ANN indexes it has, whose ids are rows of the old copy."""
+    from .ann import INDEX_TYPES, ANNIndex, build_index
+
+    kinds = []
+    for kind in INDEX_TYPES[1:]:
+        index = ANNIndex(split.lib_name, kind)
+        if index.exists():
+            os.remove(index.path)
+            kinds.append(kind)
+    split.create(docs, dtype)
+    for kind in kinds:
+        try:
+            build_index(split.lib_name, kind)
+        except ValueError as exception:
+            print(exception)
+
+
+class LibraryManifest:
+    """Size, mtime and content hash of every file loaded into a library.
+
+    Kept in `<lib>.manifest.sqlite`. A file whose size and mtime match its
+    entry was already loaded and is skipped without being read again; other
+    files are hashed and only parsed when their content is not in the library.
+    """
+
+    def __init__(self, lib_name):
+        self.path = library_path(lib_name, ".manifest.sqlite")
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, dockey TEXT)"
+        )
+        self.db.commit()
+
+    def entries(self):
+        """Map of absolute path to (size, mtime_ns, dockey)."""
+        rows = self.db.execute("SELECT path, size, mtime_ns, dockey FROM files").fetchall()
+        return {path: (size, mtime_ns, dockey) for path, size, mtime_ns, dockey in rows}
+
+    def update(self, path, stat, dockey):
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, dockey),
+        )
+        self.db.commit()
+
+    def remove(self, paths):
+        self.db.executemany("DELETE FROM files WHERE path=?", [(path,) for path in paths])
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM files")
+        self.db.commit()
+
+
+class LibraryWriter:
+    """Checkpoints documents added to `docs` through the library journal.
+
+    Adding a document only appends its own texts and embeddings to the
+    journal, to the split copy of the library if there is one, and to its
+    BM25 index, which is built first if it is missing or out of date. The
+    full snapshot is rewritten when the journal has grown large relative to it.
+    """
+
+    def __init__(self, docs, lib_name):
+        self.docs = docs
+        self.lib_name = lib_name
+        self.journal = LibraryJournal(library_path(lib_name, ".journal"))
+        self.journal.repair()
+        if not os.path.exists(library_path(lib_name)):
+            compact_library(docs, lib_name)
+        from .lexical import BM25Index
+        from .split_library import SplitLibrary
+
+        self.split = SplitLibrary(lib_name)
+        texts = [t for t in docs.texts if t.doc.dockey not in docs.deleted_dockeys]
+        if not self.split.exists():
+            self.split = None
+        elif self.split.num_rows() != len(texts):
+            self._repair_split(texts)
+        self.lexical = BM25Index(lib_name)
+        if not self.lexical.exists() or self.lexical.num_rows() != len(texts):
+            self.lexical.create(texts)
+
+    def _repair_split(self, texts):
+        # a crash between the journal and the split append leaves the split
+        # copy short of the last papers, which are appended again
+        rows = self.split.num_rows()
+        if rows < len(texts) and (rows == 0 or texts[rows - 1].doc.dockey != texts[rows].doc.dockey):
+            print("Appending %d missing chunks to the split library." % (len(texts) - rows))
+            for _, doc_texts in groupby(texts[rows:], key=lambda t: t.doc.dockey):
+                doc_texts = list(doc_texts)
+                self._append_split(doc_texts[0].doc, doc_texts)
+        else:
+            print("Split library does not match the journal, rebuilding it.")
+            rebuild_split(self.docs, self.split, self.split.dtype())
+
+    def _append_split(self, doc, texts):
+        citation_vector = self.docs.embeddings.embed_documents([doc.citation])[0]
+        self.split.append(doc, texts, citation_vector)
+
+    def commit(self, doc, texts):
+        self.journal.append(doc, texts)
+        if self.split is not None:
+            self._append_split(doc, texts)
+        self.lexical.append(texts)
+        snapshot_size = os.path.getsize(library_path(self.lib_name))
+        if self.journal.size() > max(COMPACT_MIN_BYTES, COMPACT_RATIO * snapshot_size):
+            self.compact()
+
+    def compact(self):
+        compact_library(self.docs, self.lib_name)
@@ -0,0 +1,180 @@
+import argparse
+import json
+import struct
+from array import array
+import numpy as np
+
+
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(rows, dim, descr="<f4"):
+    # fixed size header, so the row count can be patched in after streaming
+    shape = "(%d,)" % rows if dim is None else "(%d, %d)" % (rows, dim)
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %s, }" % (descr, shape)
+    header = header.ljust(117) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class ChunkTable:
+    """Columnar description of the chunks behind an embedding matrix.
+
+    Row `i` of the matrix belongs to file `paths[file_index[i]]` and its text is
+    `blob[offsets[i]:offsets[i + 1]]` decoded as UTF-8.
+    """
+
+    def __init__(self, paths, file_index, offsets, blob):
+        self.paths = paths
+        self.file_index = file_index
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.file_index)
+
+    def source(self, i):
+        return self.paths[self.file_index[i]]
+
+    def text(self, i):
+        return bytes(self.blob[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8")
+
+    def save(self, prefix):
+        with open(prefix + ".files.json", "w", encoding="utf-8") as f:
+            json.dump(self.paths, f)
+        np.save(prefix + ".file_index.npy", np.asarray(self.file_index, dtype=np.int32))
+        np.save(prefix + ".offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        if self.blob is not None:
+            with open(prefix + ".texts.bin", "wb") as f:
+                f.write(self.blob)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        with open(prefix + ".files.json", "r", encoding="utf-8") as f:
+            paths = json.load(f)
+        file_index = np.load(prefix + ".file_index.npy", mmap_mode=mmap_mode)
+        offsets = np.load(prefix + ".offsets.npy", mmap_mode=mmap_mode)
+        if offsets[-1] == 0:
+            blob = b""
+        else:
+            blob = np.memmap(prefix + ".texts.bin", dtype=np.uint8, mode="r")
+        return cls(paths, file_index, offsets, blob)
+
+
+class _TableBuilder:
+    def __init__(self, texts_file=None):
+        self.paths = []
+        self.path_ids = {}
+        self.file_index = array("i")
+        self.offsets = array("q", [0])
+        self.texts_file = texts_file
+        self.blob = bytearray()
+
+    def add(self, source, text):
+        if source not in self.path_ids:
+            self.path_ids[source] = len(self.paths)
+            self.paths.append(source)
+        self.file_index.append(self.path_ids[source])
+        data = text.encode("utf-8")
+        if self.texts_file is not None:
+            self.texts_file.write(data)
+        else:
+            self.blob.extend(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def table(self):
+        # texts streamed to a file are not kept in memory
+        blob = self.blob if self.texts_file is None else None
+        return ChunkTable(self.paths, self.file_index, self.offsets, blob)
+
+
+def write_embeddings_matrix(records, prefix):
+    """Stream (source, chunk_text, vector) records into memory-mappable files.
+
+    Writes `<prefix>.npy` with the float32 vectors, and the side table
+    `<prefix>.files.json`, `.file_index.npy`, `.offsets.npy` and `.texts.bin`.
+    Returns the number of chunks written.
+    """
+    rows = 0
+    dim = 0
+    with open(prefix + ".npy", "wb") as vectors_file, open(
+        prefix + ".texts.bin", "wb"
+    ) as texts_file:
+        vectors_file.write(npy_header(0, 0))
+        builder = _TableBuilder(texts_file)
+        for source, text, vector in records:
+            vector = np.asarray(vector, dtype="<f4")
+            if rows == 0:
+                dim = len(vector)
+            elif len(vector) != dim:
+                raise ValueError("Embedding size changed from %d to %d." % (dim, len(vector)))
+            vectors_file.write(vector.tobytes())
+            builder.add(source, text)
+            rows += 1
+        vectors_file.seek(0)
+        vectors_file.write(npy_header(rows, dim))
+    builder.table().save(prefix)
+    return rows
+
+
+def build_embeddings_matrix(records):
+    """Collect (source, chunk_text, vector) records into a float32 matrix and ChunkTable."""
+    builder = _TableBuilder()
+    rows = []
+    for source, text, vector in records:
+        rows.append(np.asarray(vector, dtype=np.float32))
+        builder.add(source, text)
+    if rows:
+        matrix = np.stack(rows)
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    return matrix, builder.table()
+
+
+def load_embeddings_matrix(prefix, mmap_mode="r"):
+    """Load files written by `write_embeddings_matrix`, memory-mapped by default."""
+    return np.load(prefix + ".npy", mmap_mode=mmap_mode), ChunkTable.load(prefix, mmap_mode)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "doc_dir", type=str, help="Path to paper directory or single paper file."
+    )
+    parser.add_argument(
+        "prefix", type=str, help="Output path prefix, e.g. './saved_libs/vectors'."
+    )
+    parser.add_argument(
+        "--embeddings",
+        type=str,
+        default="all-mpnet-base-v2",
+        help="Specify embedding model.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse papers. Default value 1.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of chunks embedded together, across papers. Default value 64.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from .qa import iter_embeddings
+
+    args = get_arguments()
+    rows = write_embeddings_matrix(
+        iter_embeddings(
+            args.doc_dir,
+            args.embeddings,
+            workers=args.workers,
+            batch_size=args.batch_size,
+        ),
+        args.prefix,
+    )
+    print("Saved %d chunk embeddings in %s.npy" % (rows, args.prefix))
@@ -0,0 +1,266 @@
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from datetime import datetime
+from paperqa.chains import make_chain
+from paperqa.types import Doc, Text
+from paperqa.readers import read_doc
+from paperqa.utils import maybe_is_text, md5sum
+from .cache import TextCache
+from .trace import NullTracer
+
+# characters shared by consecutive chunks, as in read_doc
+CHUNK_OVERLAP = 100
+# bumped when extract_file changes, so cached texts are extracted again
+EXTRACT_VERSION = 3
+
+
+def list_files(doc_dir):
+    if os.path.isdir(doc_dir):
+        file_names = os.listdir(doc_dir)
+        return [
+            os.path.join(doc_dir, f)
+            for f in file_names
+            if os.path.isfile(os.path.join(doc_dir, f))
+        ]
+    return [doc_dir]
+
+
+def _read_text(f):
+    try:
+        with open(f) as file:
+            return file.read()
+    except UnicodeDecodeError:
+        with open(f, encoding="utf-8", errors="ignore") as file:
+            return file.read()
+
+
+def extract_file(f):
+    """Text of a file before chunking, extracted the way read_doc does.
+
+    Returns ("pages", [text of each page]) for PDFs, ("text", text) for text
+    and HTML files, or None for other files, which read_doc chunks by line.
+    Boilerplate is stripped from HTML with `html_text.html_to_text` when lxml
+    is installed, otherwise the page is converted whole with html2text.
+    """
+    if f.endswith(".pdf"):
+        try:
+            import fitz
+
+            with fitz.open(f) as file:
+                return "pages", [page.get_text("text", sort=True) for page in file]
+        except ImportError:
+            import pypdf
+
+            with open(f, "rb") as file:
+                return "pages", [page.extract_text() for page in pypdf.PdfReader(file).pages]
+    if f.endswith(".txt"):
+        return "text", _read_text(f)
+    if f.endswith(".html"):
+        raw = _read_text(f)
+        try:
+            from .html_text import html_to_text
+
+            text = html_to_text(raw)
+        except ImportError:
+            text = ""
+        if not text:
+            from html2text import html2text
+
+            text = html2text(raw)
+        return "text", text
+    return None
+
+
+def chunk_extracted(extracted, doc, chunk_chars=3000, overlap=CHUNK_OVERLAP):
+    """Chunk the output of `extract_file` into the texts read_doc would return."""
+    kind, content = extracted
+    if kind == "text":
+        from langchain.text_splitter import TokenTextSplitter
+
+        splitter = TokenTextSplitter(chunk_size=chunk_chars, chunk_overlap=overlap)
+        return [
+            Text(text=t, name=f"{doc.docname} chunk {i}", doc=doc)
+            for i, t in enumerate(splitter.split_text(content))
+        ]
+    # pages are joined and cut every chunk_chars characters, and each chunk is
+    # named after the pages it spans
+    split = ""
+    pages = []
+    texts = []
+    for i, page in enumerate(content):
+        split += page
+        pages.append(str(i + 1))
+        while len(split) > chunk_chars:
+            pg = "-".join([pages[0], pages[-1]])
+            texts.append(Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc))
+            split = split[chunk_chars - overlap :]
+            pages = [str(i + 1)]
+    if len(split) > overlap:
+        pg = "-".join([pages[0], pages[-1]])
+        texts.append(Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc))
+    return texts
+
+
+def _timed_read_file(f, chunk_chars, text_cache=None, dockey=None):
+    timings = []
+    stage = "hash"
+    start = time.time()
+    try:
+        if dockey is None:
+            dockey = md5sum(f)
+            timings.append((stage, start, time.time() - start))
+        fake_doc = Doc(docname="", citation="", dockey=dockey)
+        extracted = None
+        cache = TextCache(text_cache, version=EXTRACT_VERSION) if text_cache else None
+        if cache is not None:
+            stage, start = "text_cache", time.time()
+            extracted = cache.get(dockey)
+            timings.append((stage, start, time.time() - start))
+        if extracted is None:
+            stage, start = "parse", time.time()
+            extracted = extract_file(f)
+            if extracted is not None and cache is not None:
+                cache.put(dockey, extracted)
+            timings.append((stage, start, time.time() - start))
+        if extracted is None:
+            stage, start = "parse", time.time()
+            texts = read_doc(f, fake_doc, chunk_chars=chunk_chars)
+        else:
+            stage, start = "chunk", time.time()
+            texts = chunk_extracted(extracted, fake_doc, chunk_chars)
+        timings.append((stage, start, time.time() - start))
+        return texts, None, timings, os.getpid()
+    except Exception as exception:
+        timings.append((stage, start, time.time() - start))
+        return [], exception, timings, os.getpid()
+
+
+def read_file(f, chunk_chars=3000, text_cache=None, dockey=None):
+    """Chunk one file with a placeholder Doc. Returns (texts, exception).
+
+    PDF, text and HTML files are extracted with `extract_file` and chunked
+    like read_doc does; other files go through read_doc. With a `text_cache`
+    directory, the extracted text is cached there and files found in it are
+    only chunked again. The file is hashed for its dockey unless `dockey` is
+    given.
+    """
+    return _timed_read_file(f, chunk_chars, text_cache, dockey)[:2]
+
+
+def _read_files(file_list, chunk_chars, text_cache, dockeys):
+    return [
+        _timed_read_file(f, chunk_chars, text_cache, dockey)
+        for f, dockey in zip(file_list, dockeys)
+    ]
+
+
+def _record(tracer, f, result):
+    texts, exception, timings, pid = result
+    for stage, start, seconds in timings:
+        tracer.add(stage, start, seconds, file=f, count=len(texts), pid=pid, tid=pid)
+    return f, texts, exception
+
+
+def parse_files(
+    file_list,
+    chunk_chars=3000,
+    workers=1,
+    batch_files=8,
+    tracer=None,
+    text_cache=None,
+    dockeys=None,
+):
+    """Yield (file, texts, exception) for every file, in file_list order.
+
+    With more than one worker, files are handed to a process pool in groups of
+    `batch_files`, and only a few groups per worker are in flight at once, so
+    results stream back in order without buffering the whole directory.
+    Hashing and read_doc time of each file is recorded in `tracer`. `dockeys`
+    are the md5 hashes of the files if the caller already has them. See
+    `read_file` for `text_cache`.
+    """
+    if tracer is None:
+        tracer = NullTracer()
+    if dockeys is None:
+        dockeys = [None] * len(file_list)
+    if workers is None or workers <= 1:
+        for f, dockey in zip(file_list, dockeys):
+            yield _record(tracer, f, _timed_read_file(f, chunk_chars, text_cache, dockey))
+        return
+    groups = [
+        (file_list[i : i + batch_files], dockeys[i : i + batch_files])
+        for i in range(0, len(file_list), batch_files)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        groups = iter(groups)
+        for group, group_dockeys in groups:
+            pending.append(
+                (
+                    group,
+                    executor.submit(_read_files, group, chunk_chars, text_cache, group_dockeys),
+                )
+            )
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            group, future = pending.popleft()
+            for f, result in zip(group, future.result()):
+                yield _record(tracer, f, result)
+            next_group, next_dockeys = next(groups, (None, None))
+            if next_group is not None:
+                pending.append(
+                    (
+                        next_group,
+                        executor.submit(
+                            _read_files, next_group, chunk_chars, text_cache, next_dockeys
+                        ),
+                    )
+                )
+
+
+def _docname_from_citation(citation):
+    # same heuristic paperqa.Docs.add uses: first capitalized word and a year
+    match = re.search(r"([A-Z][a-z]+)", citation)
+    author = match.group(1) if match is not None else "Unknown"
+    match = re.search(r"(\d{4})", citation)
+    year = match.group(1) if match is not None else ""
+    return f"{author}{year}"
+
+
+def add_parsed(docs, path, texts, citation=None, docname=None, tracer=None):
+    """Add a file already chunked by `read_file` to `docs`.
+
+    This is `Docs.add` without the second `read_doc` call: the placeholder
+    Doc on each chunk is replaced by the real one and chunk names are prefixed
+    with the final docname. Returns the list of added texts, empty if the
+    document was already in the library.
+    """
+    if len(texts) == 0 or len(texts[0].text) < 10 or not maybe_is_text(texts[0].text):
+        raise ValueError(f"This does not look like a text document: {path}.")
+    dockey = texts[0].doc.dockey
+    if dockey in docs.docs:
+        return []
+    if tracer is None:
+        tracer = NullTracer()
+    if citation is None:
+        # as in Docs.add, without the system prompt, which makes it too hesitant
+        cite_chain = make_chain(prompt=docs.prompts.cite, llm=docs.summary_llm, skip_system=True)
+        with tracer.span("citation", file=path):
+            citation = cite_chain.run(texts[0].text)
+        if len(citation) < 3 or "Unknown" in citation or "insufficient" in citation:
+            citation = f"Unknown, {os.path.basename(path)}, {datetime.now().year}"
+    if docname is None:
+        docname = _docname_from_citation(citation)
+    doc = Doc(docname=docs._get_unique_name(docname), citation=citation, dockey=dockey)
+    texts = [
+        Text(text=t.text, name=doc.docname + t.name, doc=doc, embeddings=t.embeddings)
+        for t in texts
+    ]
+    with tracer.span("add", file=path, count=len(texts)):
+        if not docs.add_texts(texts, doc):
+            return []
+    return texts
@@ -1,12 +1,38 @@
 import argparse
 import os
-import pickle
 import string
 from tqdm import tqdm
 from paperqa import Docs
-from paperqa.types import Doc
-from paperqa.readers import read_doc
 from paperqa.utils import md5sum
+from .ann import INDEX_TYPES, build_index
+from .answer_cache import AnswerCache
+from .batch import run_batch
+from .cache import DEFAULT_CACHE_DIR, DEFAULT_TEXT_CACHE_DIR, EmbeddingCache, embeddings_name
+from .cpu_backend import BACKENDS, set_cpu_threads
+from .dedup import ChunkDeduplicator
+from .embed_pool import EmbeddingWorkerPool
+from .embedding import embed_file_list, get_embedding_model
+from .federated import FederatedVectorStore, load_federated
+from .lexical import RETRIEVAL_MODES, hybrid_store
+from .library import (
+    LibraryManifest,
+    LibraryWriter,
+    convert_library,
+    library_path,
+    library_version,
+    load_library,
+    remove_documents,
+)
+from .matrix import (
+    build_embeddings_matrix,
+    load_embeddings_matrix,
+    write_embeddings_matrix,
+)
+from .parse import add_parsed, list_files, parse_files
+from .quantize import DTYPES
+from .serving import LibraryReloader, QueryPool, QueueFull, version_id
+from .split_library import SplitLibrary
+from .trace import NullTracer, Tracer
 
 
 def format_filename(s):
@@ -34,201 +60,637 @@ def get_arguments():
     parser.add_argument(
         "--lib_name",
         type=str,
+        nargs="+",
         help="Name of the paper library: an existing name or a new name. "
-        "The library will be loaded or saved as pkl file in './saved_libs' directory.",
+        "The library will be loaded or saved as pkl file in './saved_libs' directory. "
+        "The QA tools accept several names to answer from all of those libraries.",
     )
     group.add_argument(
         "-r", "--run", action="store_true", help="Run command line QA tool."
     )
     group.add_argument("-w", "--web", action="store_true", help="Run webpage QA tool.")
+    group.add_argument(
+        "--questions_file",
+        "--questions-file",
+        type=str,
+        help="Answer every question of this file, one per line or a JSONL file with "
+        "'question' and optional 'id' fields, and write the results to --answers_file.",
+    )
+    group.add_argument(
+        "--convert",
+        action="store_true",
+        help="Convert the pkl library to the split format, which is loaded lazily by the QA tools.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=DTYPES,
+        default="float32",
+        help="How vectors of the split library are stored by --convert, or by --load when it "
+        "creates the split library for --index: 'float32', 'float16' (half the memory) or "
+        "'int8' with a scale per vector (a quarter). Default value 'float32'.",
+    )
     parser.add_argument(
         "--port",
         type=int,
         default=80,
         help="Which port should webpage QA tool use. Default value 80.",
     )
+    parser.add_argument(
+        "--shared_dir",
+        type=str,
+        help="Directory with a shared memory copy of the split libraries, made by "
+        "qatool.launch, read by the webpage QA tool instead of './saved_libs'.",
+    )
+    parser.add_argument(
+        "--reload_interval",
+        type=float,
+        default=60,
+        help="Seconds between checks of the webpage QA tool for a new version of the library, "
+        "which is loaded in the background and replaces the served one. 0 turns reloading off. "
+        "Default value 60.",
+    )
     parser.add_argument(
         "--embeddings",
         type=str,
         default="all-mpnet-base-v2",
         help="Specify embedding model.",
     )
+    parser.add_argument(
+        "--embedding_backend",
+        type=str,
+        choices=BACKENDS,
+        default="torch",
+        help="How the embedding model runs: 'torch' as is, or 'int8' with its linear layers "
+        "quantized to int8 for faster CPU inference. Vectors stored in libraries are "
+        "compatible with both. Default value 'torch'.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads the embedding model uses. One per CPU by default.",
+    )
+    parser.add_argument(
+        "--cpu_affinity",
+        type=str,
+        help="CPUs the tools run on, e.g. '0-7' or '0,2,4,6'. All by default.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to parse papers when loading. Default value 1.",
+    )
+    parser.add_argument(
+        "--embed_workers",
+        type=int,
+        default=1,
+        help="Number of processes embedding chunks when loading, each with its own copy of "
+        "the embedding model. Default value 1, embedding in this process.",
+    )
+    parser.add_argument(
+        "--embed_threads",
+        type=int,
+        help="Number of threads of each embedding process. By default the CPUs are shared "
+        "evenly between them.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of chunks embedded together, across papers. Default value 64.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help="Directory of the embedding cache used when loading papers. "
+        "Pass an empty string to disable it. Default path './saved_libs/embedding_cache'.",
+    )
+    parser.add_argument(
+        "--chunk_chars",
+        type=int,
+        default=3000,
+        help="Size of the chunks papers are split into when loading. Default value 3000.",
+    )
+    parser.add_argument(
+        "--text_cache_dir",
+        type=str,
+        default=DEFAULT_TEXT_CACHE_DIR,
+        help="Directory where the text extracted from papers is cached, so loading them again "
+        "with another --chunk_chars or --embeddings does not parse them again. Pass an empty "
+        "string to disable it. Default path './saved_libs/text_cache'.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=10,
+        help="Maximum size of the embedding cache in GB. Default value 10.",
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        choices=INDEX_TYPES,
+        default="flat",
+        help="Nearest neighbour index used for retrieval: exact 'flat' search, or an "
+        "approximate 'hnsw' or 'ivfpq' index built with --load. Default value 'flat'.",
+    )
+    parser.add_argument(
+        "--retrieval",
+        type=str,
+        choices=RETRIEVAL_MODES,
+        default="dense",
+        help="How chunks are retrieved: by embedding only ('dense'), by ranking the best "
+        "BM25 matches of the question by embedding ('prefilter'), or by fusing the BM25 and "
+        "embedding rankings ('fusion'). Default value 'dense'.",
+    )
+    parser.add_argument(
+        "--answer_threshold",
+        type=float,
+        default=1.0,
+        help="Questions whose embedding has at least this cosine similarity with an "
+        "earlier question reuse its cached answer, e.g. 0.95. 1 only reuses identical "
+        "questions. Default value 1.",
+    )
+    parser.add_argument(
+        "--no_answer_cache",
+        action="store_true",
+        help="Do not cache answers of the QA tools.",
+    )
+    parser.add_argument(
+        "--query_workers",
+        type=int,
+        default=4,
+        help="Number of questions the webpage QA tool or --questions_file answers at the same "
+        "time. Default value 4.",
+    )
+    parser.add_argument(
+        "--answers_file",
+        type=str,
+        default="./answers.jsonl",
+        help="JSONL file --questions_file writes answers, contexts and costs to. Questions "
+        "already answered in it are skipped, so an interrupted run can be resumed. "
+        "Default path './answers.jsonl'.",
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=int,
+        help="Maximum number of LLM tokens --questions_file uses per minute. No limit by default.",
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        default=32,
+        help="Number of questions the webpage QA tool queues before turning new ones away. "
+        "Default value 32.",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="When loading, remove papers whose files were deleted from the loaded directory "
+        "since the last load, and the old versions of files that changed.",
+    )
+    parser.add_argument(
+        "--dedup",
+        type=float,
+        nargs="?",
+        const=0.8,
+        help="Drop chunks of loaded papers that are near duplicates of chunks already in the "
+        "library or loaded earlier, e.g. an abstract file and the PDF of the same paper. "
+        "Optionally takes the share of a chunk found in an earlier chunk above which it is "
+        "dropped, 0.8 by default.",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        help="Record the time spent in every loading stage, per paper, and save it to this file.",
+    )
+    parser.add_argument(
+        "--trace_format",
+        type=str,
+        choices=["json", "chrome"],
+        default="json",
+        help="Format of the --trace file: a plain 'json' event list or 'chrome' trace events "
+        "for chrome://tracing and Perfetto. Default value 'json'.",
+    )
     return parser.parse_args()
 
 
-def get_embedding_model(embeddings):
-    if embeddings in ["hkunlp/instructor-large", "hkunlp/instructor-xl"]:
-        from langchain.embeddings import HuggingFaceInstructEmbeddings
-
-        model_kwargs = {"device": "cpu"}
-        encode_kwargs = {"normalize_embeddings": True}
-        return HuggingFaceInstructEmbeddings(
-            model_name=embeddings,
-            model_kwargs=model_kwargs,
-            encode_kwargs=encode_kwargs,
-        )
-    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
-
-    return HuggingFaceEmbeddings(model_name=embeddings)
+def iter_chunked_texts(doc_dir, workers=1, chunk_chars=3000, text_cache_dir=None):
+    file_list = list_files(doc_dir)
+    for f, texts, exception in tqdm(
+        parse_files(
+            file_list, chunk_chars=chunk_chars, workers=workers, text_cache=text_cache_dir
+        ),
+        total=len(file_list),
+    ):
+        if exception is not None:
+            print(exception)
+            continue
+        for single_texts in texts:
+            yield f, single_texts.text
 
 
-def get_chunked_texts(doc_dir):
-    texts_list = []
-    if os.path.isdir(doc_dir):
-        file_names = os.listdir(doc_dir)
-        file_list = [
-            os.path.join(doc_dir, f)
-            for f in file_names
-            if os.path.isfile(os.path.join(doc_dir, f))
-        ]
-    else:
-        file_list = [doc_dir]
-    for f in tqdm(file_list):
-        fake_doc = Doc(docname="", citation="", dockey=md5sum(f))
-        try:
-            texts = read_doc(f, fake_doc, chunk_chars=3000)
-            if len(texts) == 0:
-                continue
-            for single_texts in texts:
-                texts_list.append(single_texts.text)
-        except Exception as exception:
+def iter_embeddings(
+    doc_dir,
+    embeddings_name="all-mpnet-base-v2",
+    workers=1,
+    batch_size=64,
+    cache_dir=None,
+    chunk_chars=3000,
+    text_cache_dir=None,
+):
+    if embeddings_name is None or embeddings_name == "":
+        for f, text in iter_chunked_texts(
+            doc_dir, workers=workers, chunk_chars=chunk_chars, text_cache_dir=text_cache_dir
+        ):
+            yield f, text, None
+        return
+    file_list = list_files(doc_dir)
+    embeddings = get_embedding_model(embeddings_name)
+    cache = EmbeddingCache(cache_dir) if cache_dir else None
+    for f, texts, text_embeddings, exception in tqdm(
+        embed_file_list(
+            file_list,
+            embeddings,
+            chunk_chars=chunk_chars,
+            workers=workers,
+            batch_size=batch_size,
+            cache=cache,
+            text_cache=text_cache_dir,
+        ),
+        total=len(file_list),
+    ):
+        if exception is not None:
             print(exception)
             continue
-    return texts_list
+        for single_texts, single_embeddings in zip(texts, text_embeddings):
+            yield f, single_texts.text, single_embeddings
+
+
+def get_chunked_texts(doc_dir, workers=1, chunk_chars=3000, text_cache_dir=None):
+    return [
+        text
+        for _, text in iter_chunked_texts(
+            doc_dir, workers=workers, chunk_chars=chunk_chars, text_cache_dir=text_cache_dir
+        )
+    ]
 
 
-def get_embeddings(doc_dir, embeddings_name="all-mpnet-base-v2"):
+def get_embeddings(
+    doc_dir,
+    embeddings_name="all-mpnet-base-v2",
+    workers=1,
+    batch_size=64,
+    cache_dir=None,
+    chunk_chars=3000,
+    text_cache_dir=None,
+):
     if embeddings_name is None or embeddings_name == "":
-        return get_chunked_texts(doc_dir), []
-    if os.path.isdir(doc_dir):
-        file_names = os.listdir(doc_dir)
-        file_list = [
-            os.path.join(doc_dir, f)
-            for f in file_names
-            if os.path.isfile(os.path.join(doc_dir, f))
-        ]
-    else:
-        file_list = [doc_dir]
-    embeddings = get_embedding_model(embeddings_name)
+        return (
+            get_chunked_texts(
+                doc_dir, workers=workers, chunk_chars=chunk_chars, text_cache_dir=text_cache_dir
+            ),
+            [],
+        )
     texts_list = []
     embeddings_list = []
-    for f in tqdm(file_list):
-        if not os.path.isfile(f):
-            continue
-        fake_doc = Doc(docname="", citation="", dockey=md5sum(f))
-        texts = read_doc(f, fake_doc, chunk_chars=3000)
-        try:
-            if len(texts) == 0:
-                continue
-            text_embeddings = embeddings.embed_documents([t.text for t in texts])
-            for single_texts, single_embeddings in zip(texts, text_embeddings):
-                texts_list.append(single_texts.text)
-                embeddings_list.append(single_embeddings)
-        except Exception as e:
-            print(e)
-            continue
+    for _, text, vector in iter_embeddings(
+        doc_dir,
+        embeddings_name,
+        workers=workers,
+        batch_size=batch_size,
+        cache_dir=cache_dir,
+        chunk_chars=chunk_chars,
+        text_cache_dir=text_cache_dir,
+    ):
+        texts_list.append(text)
+        embeddings_list.append(vector)
     return texts_list, embeddings_list
 
 
-def get_chunked_texts_with_source(doc_dir):
-    texts_list = []
-    if os.path.isdir(doc_dir):
-        file_names = os.listdir(doc_dir)
-        file_list = [
-            os.path.join(doc_dir, f)
-            for f in file_names
-            if os.path.isfile(os.path.join(doc_dir, f))
-        ]
-    else:
-        file_list = [doc_dir]
-    for f in tqdm(file_list):
-        if not os.path.isfile(f):
-            continue
-        fake_doc = Doc(docname="", citation="", dockey=md5sum(f))
-        try:
-            texts = read_doc(f, fake_doc, chunk_chars=3000)
-            if len(texts) == 0:
-                continue
-            for single_texts in texts:
-                texts_list.append((f, single_texts.text))
-        except Exception as exception:
-            print(exception)
-            continue
-    return texts_list
+def get_chunked_texts_with_source(doc_dir, workers=1, chunk_chars=3000, text_cache_dir=None):
+    return list(
+        iter_chunked_texts(
+            doc_dir, workers=workers, chunk_chars=chunk_chars, text_cache_dir=text_cache_dir
+        )
+    )
 
 
-def get_embeddings_with_source(doc_dir, embeddings_name="all-mpnet-base-v2"):
+def get_embeddings_with_source(
+    doc_dir,
+    embeddings_name="all-mpnet-base-v2",
+    workers=1,
+    batch_size=64,
+    cache_dir=None,
+    chunk_chars=3000,
+    text_cache_dir=None,
+):
     if embeddings_name is None or embeddings_name == "":
-        return get_chunked_texts_with_source(doc_dir), []
-    if os.path.isdir(doc_dir):
-        file_names = os.listdir(doc_dir)
-        file_list = [
-            os.path.join(doc_dir, f)
-            for f in file_names
-            if os.path.isfile(os.path.join(doc_dir, f))
-        ]
-    else:
-        file_list = [doc_dir]
-    embeddings = get_embedding_model(embeddings_name)
+        return (
+            get_chunked_texts_with_source(
+                doc_dir, workers=workers, chunk_chars=chunk_chars, text_cache_dir=text_cache_dir
+            ),
+            [],
+        )
     texts_list = []
     embeddings_list = []
-    for f in tqdm(file_list):
-        if not os.path.isfile(f):
-            continue
-        fake_doc = Doc(docname="", citation="", dockey=md5sum(f))
-        try:
-            texts = read_doc(f, fake_doc, chunk_chars=3000)
-            if len(texts) == 0:
-                continue
-            text_embeddings = embeddings.embed_documents([t.text for t in texts])
-            for single_texts, single_embeddings in zip(texts, text_embeddings):
-                texts_list.append((f, single_texts.text))
-                embeddings_list.append((f, single_embeddings))
-        except Exception as exception:
-            print(exception)
-            continue
+    for f, text, vector in iter_embeddings(
+        doc_dir,
+        embeddings_name,
+        workers=workers,
+        batch_size=batch_size,
+        cache_dir=cache_dir,
+        chunk_chars=chunk_chars,
+        text_cache_dir=text_cache_dir,
+    ):
+        texts_list.append((f, text))
+        embeddings_list.append((f, vector))
     return texts_list, embeddings_list
 
 
-def load_papers(doc_dir, lib_name, embeddings):
-    llm = "gpt-3.5-turbo"
-    embeddings = get_embedding_model(embeddings)
-    lib_dir = "./saved_libs/" + lib_name + ".pkl"
+def get_embeddings_matrix(
+    doc_dir,
+    embeddings_name="all-mpnet-base-v2",
+    output_prefix=None,
+    workers=1,
+    batch_size=64,
+    cache_dir=None,
+    chunk_chars=3000,
+    text_cache_dir=None,
+):
+    if embeddings_name is None or embeddings_name == "":
+        raise ValueError("An embedding model is required to build an embedding matrix.")
+    records = iter_embeddings(
+        doc_dir,
+        embeddings_name,
+        workers=workers,
+        batch_size=batch_size,
+        cache_dir=cache_dir,
+        chunk_chars=chunk_chars,
+        text_cache_dir=text_cache_dir,
+    )
+    if output_prefix is None:
+        return build_embeddings_matrix(records)
+    write_embeddings_matrix(records, output_prefix)
+    return load_embeddings_matrix(output_prefix)
+
+
+def scan_changes(doc_dir, file_list, docs, manifest, tracer):
+    """Compare `file_list` with the library manifest.
+
+    Returns the files to load, a map of file to (stat, dockey) for updating
+    the manifest, the manifest paths under `doc_dir` whose files are gone, and
+    the dockeys of their entries and of the old content of changed files.
+    """
+    entries = manifest.entries()
+    to_load = []
+    found = {}
+    replaced = set()
+    for f in file_list:
+        stat = os.stat(f)
+        entry = entries.get(os.path.abspath(f))
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            continue
+        with tracer.span("hash", file=f):
+            dockey = md5sum(f)
+        found[f] = (stat, dockey)
+        if entry is not None and entry[2] != dockey:
+            replaced.add(entry[2])
+        if dockey in docs.docs:
+            # same content as a paper already loaded, only the manifest is behind
+            manifest.update(f, stat, dockey)
+        else:
+            to_load.append(f)
+    root = os.path.abspath(doc_dir)
+    current = {os.path.abspath(f) for f in file_list}
+    removed = [
+        path
+        for path in entries
+        if (path == root or path.startswith(os.path.join(root, ""))) and path not in current
+    ]
+    stale = replaced | {entries[path][2] for path in removed}
+    return to_load, found, removed, stale
+
+
+def load_papers(
+    doc_dir,
+    lib_name,
+    embeddings,
+    workers=1,
+    batch_size=64,
+    cache_dir=DEFAULT_CACHE_DIR,
+    cache_size=10 * 1024**3,
+    index="flat",
+    llm="gpt-3.5-turbo",
+    trace=None,
+    trace_format="json",
+    dedup=None,
+    prune=False,
+    dtype="float32",
+    chunk_chars=3000,
+    text_cache_dir=DEFAULT_TEXT_CACHE_DIR,
+    backend="torch",
+    embed_workers=1,
+    embed_threads=None,
+):
+    tracer = Tracer() if trace else NullTracer()
+    lib_dir = library_path(lib_name)
+    manifest = LibraryManifest(lib_name)
     if os.path.exists(lib_dir):
-        docs = pickle.load(open(lib_dir, "rb"))
+        docs = load_library(lib_name)
     else:
-        docs = Docs(llm=llm, embeddings=embeddings)
-    if os.path.isdir(doc_dir):
-        file_names = os.listdir(doc_dir)
+        docs = Docs(llm=llm, embeddings=get_embedding_model(embeddings))
+        manifest.clear()
+    with tracer.span("scan"):
         file_list = [
-            os.path.join(doc_dir, f)
-            for f in file_names
-            if os.path.isfile(os.path.join(doc_dir, f))
+            f for f in list_files(doc_dir) if os.path.isfile(f) and os.stat(f).st_size > 0
         ]
-    else:
-        file_list = [doc_dir]
-    for f in tqdm(file_list):
-        if not os.path.isfile(f):
-            continue
-        if f in docs.docs:
-            continue
-        if os.stat(f).st_size == 0:
+        to_load, found, removed, stale = scan_changes(
+            doc_dir, file_list, docs, manifest, tracer
+        )
+    print(
+        "%d of %d files are new or changed since the last load."
+        % (len(to_load), len(file_list))
+    )
+    if prune and (removed or stale):
+        # keep papers still listed under another path
+        changed = {os.path.abspath(f) for f in found}
+        kept = {
+            entry[2]
+            for path, entry in manifest.entries().items()
+            if path not in removed and path not in changed
+        }
+        kept |= {dockey for _, dockey in found.values()}
+        with tracer.span("prune"):
+            num_removed = remove_documents(docs, lib_name, stale - kept)
+            manifest.remove(removed)
+        print("Removed %d papers whose files were deleted or changed." % num_removed)
+        if dedup is not None:
+            # files skipped as duplicates may have duplicated a removed paper
+            entries = manifest.entries()
+            queued = set(to_load)
+            for f in file_list:
+                entry = entries.get(os.path.abspath(f))
+                if entry is not None and entry[2] not in docs.docs and f not in queued:
+                    to_load.append(f)
+                    found[f] = (os.stat(f), entry[2])
+    if index != "flat" and not SplitLibrary(lib_name).exists():
+        # ANN indexes are built over the rows of the split library
+        SplitLibrary(lib_name).create(docs, dtype)
+    writer = LibraryWriter(docs, lib_name)
+    embedder = docs.embeddings
+    if backend != "torch":
+        # the library keeps the reference model, only new chunks use the backend
+        embedder = get_embedding_model(embeddings_name(docs.embeddings), backend=backend)
+    pool = None
+    if embed_workers > 1:
+        pool = EmbeddingWorkerPool(
+            embeddings_name(docs.embeddings),
+            workers=embed_workers,
+            threads=embed_threads,
+            backend=backend,
+            batch_size=batch_size,
+        )
+        embedder = pool
+    cache = EmbeddingCache(cache_dir, max_bytes=cache_size) if cache_dir else None
+    deduplicator = None
+    if dedup is not None:
+        # full texts before abstracts, so the abstract is the copy dropped
+        to_load.sort(key=lambda f: f.endswith(".txt"))
+        deduplicator = ChunkDeduplicator(threshold=dedup)
+        with tracer.span("dedup", count=len(docs.texts)):
+            deduplicator.seed(docs.texts, docs.deleted_dockeys)
+    for f, texts, text_embeddings, exception in tqdm(
+        embed_file_list(
+            to_load,
+            embedder,
+            chunk_chars=chunk_chars,
+            workers=workers,
+            batch_size=batch_size,
+            cache=cache,
+            tracer=tracer,
+            dedup=deduplicator,
+            text_cache=text_cache_dir,
+            # hashed by scan_changes
+            dockeys=[found[f][1] for f in to_load],
+        ),
+        total=len(to_load),
+    ):
+        if deduplicator is not None and f in deduplicator.skipped_files:
+            manifest.update(f, *found[f])
             continue
         try:
+            if exception is not None:
+                raise exception
+            for single_texts, single_embeddings in zip(texts, text_embeddings):
+                single_texts.embeddings = single_embeddings
             if f.endswith('.txt'): # do not generate citations for txt chunks
-                docs.add(f, chunk_chars=3000, citation='Chunk file ' + os.path.basename(f), docname=os.path.basename(f))
+                new_texts = add_parsed(docs, f, texts, citation='Chunk file ' + os.path.basename(f), docname=os.path.basename(f), tracer=tracer)
             else:
-                docs.add(f, chunk_chars=3000)
+                new_texts = add_parsed(docs, f, texts, tracer=tracer)
         except Exception as exception:
             print(exception)
             continue
-        pickle.dump(docs, open(lib_dir, "wb"))
+        if new_texts:
+            with tracer.span("persist", file=f, count=len(new_texts)):
+                writer.commit(new_texts[0].doc, new_texts)
+        manifest.update(f, *found[f])
+    if pool is not None:
+        pool.close()
+    if deduplicator is not None:
+        superseded = deduplicator.superseded_dockeys() & set(docs.docs)
+        if superseded:
+            with tracer.span("dedup", count=len(superseded)):
+                num_removed = remove_documents(docs, lib_name, superseded)
+            print("Removed %d papers whose text is contained in papers loaded now." % num_removed)
+    if index != "flat":
+        try:
+            with tracer.span("index"):
+                build_index(lib_name, index)
+        except ValueError as exception:
+            print(exception)
+    if deduplicator is not None:
+        deduplicator.print_report()
+    if cache is not None:
+        stats = cache.stats()
+        stats["hit_rate"] = 100 * stats["hit_rate"]
+        print("Embedding cache: %(hits)d hits, %(misses)d misses, hit rate %(hit_rate).1f%%" % stats)
     print("Finishing loading papers! Library saved in %s" % os.path.abspath(lib_dir))
+    if trace:
+        tracer.print_summary()
+        tracer.save(trace, trace_format)
+        print("Loading trace saved in %s" % os.path.abspath(trace))
+
+
+def answer_question(docs, question, answer_cache=None):
+    vector = None
+    if answer_cache is not None:
+        answer, vector = answer_cache.lookup(question)
+        if answer is not None:
+            return answer
+    answer = docs.query(question, k=10, max_sources=10).formatted_answer
+    if answer_cache is not None:
+        answer_cache.put(question, answer, vector)
+    return answer
+
+
+def open_library(lib_name, index="flat", backend="torch", retrieval="dense", shared_dir=None):
+    if isinstance(lib_name, str):
+        docs = load_library(lib_name, lazy=True, index=index, shared_dir=shared_dir)
+    elif len(lib_name) == 1:
+        docs = load_library(lib_name[0], lazy=True, index=index, shared_dir=shared_dir)
+    else:
+        docs = load_federated(lib_name, index=index, shared_dir=shared_dir)
+    if backend != "torch":
+        # questions are embedded with the backend, the stored vectors are unchanged
+        docs.embeddings = get_embedding_model(embeddings_name(docs.embeddings), backend=backend)
+        for index_store in (docs.texts_index, docs.doc_index):
+            if hasattr(index_store, "embedding"):
+                index_store.embedding = docs.embeddings
+            elif hasattr(index_store, "embedding_function"):
+                # FAISS indexes pickled with a pkl library, which keep either
+                # the model or its embed_query
+                if hasattr(index_store.embedding_function, "embed_query"):
+                    index_store.embedding_function = docs.embeddings
+                else:
+                    index_store.embedding_function = docs.embeddings.embed_query
+    if retrieval != "dense":
+        if isinstance(docs.texts_index, FederatedVectorStore):
+            raise ValueError("BM25 retrieval only searches one library at a time.")
+        name = lib_name if isinstance(lib_name, str) else lib_name[0]
+        docs.texts_index = hybrid_store(docs, name, retrieval)
+    return docs
+
+
+def print_shard_latencies(docs):
+    if isinstance(docs.texts_index, FederatedVectorStore):
+        print(
+            "Retrieval latency per library: "
+            + ", ".join(
+                "%s %.0f ms" % (name, 1000 * seconds)
+                for name, seconds in docs.texts_index.latencies().items()
+            )
+        )
+
 
+def close_library(docs):
+    """Stop the search threads of a library opened with `open_library`."""
+    close = getattr(docs.texts_index, "close", None)
+    if close is not None:
+        close()
 
-def run_qa(lib_name):
-    lib_dir = "./saved_libs/" + lib_name + ".pkl"
-    docs = pickle.load(open(lib_dir, "rb"))
+
+def run_qa(lib_name, index="flat", answer_threshold=1.0, backend="torch", retrieval="dense"):
+    docs = open_library(lib_name, index=index, backend=backend, retrieval=retrieval)
+    answer_cache = None
+    if answer_threshold is not None:
+        answer_cache = AnswerCache(
+            lib_name,
+            docs.embeddings,
+            threshold=answer_threshold,
+            scope="%s/%s" % (index, retrieval),
+        )
     question = ""
     while True:
         question = input("Ask something or type 'exit': ")
@@ -237,64 +699,201 @@ def run_qa(lib_name):
             question = input("Ask something or type 'exit': ")
         if question == "exit":
             break
-        answer = docs.query(question, k=10, max_sources=10)
-        print(answer.formatted_answer)
+        print(answer_question(docs, question, answer_cache))
+        print_shard_latencies(docs)
+    close_library(docs)
+    if answer_cache is not None:
+        print("Answer cache hit rate: %(hit_rate).1f%%" % {"hit_rate": 100 * answer_cache.stats()["hit_rate"]})
 
 
-def run_webqa(lib_name, port):
+def run_webqa(
+    lib_name,
+    port,
+    index="flat",
+    answer_threshold=1.0,
+    query_workers=4,
+    max_queue=32,
+    backend="torch",
+    retrieval="dense",
+    shared_dir=None,
+    reload_interval=60,
+):
+    import asyncio
     import pywebio
-    import threading
     import gc
     import nest_asyncio
+    from pywebio.session import run_asyncio_coroutine
 
     nest_asyncio.apply()
     gc.collect()
 
-    lib_dir = "./saved_libs/" + lib_name + ".pkl"
-    docs = pickle.load(open(lib_dir, "rb"))
+    lib_names = [lib_name] if isinstance(lib_name, str) else lib_name
 
-    @pywebio.config(title="Delt4: PaperQA beta")
-    def app():
-        pywebio.output.put_markdown("## Delt4: Aging PaperQA beta")
-        pywebio.output.put_markdown("Lib name: %s" % lib_name)
+    def prepare(docs):
+        # paperqa builds these indexes on the first question, which would
+        # otherwise run alone after every reload
+        if docs.texts_index is None:
+            docs._build_texts_index()
+        if docs.doc_index is None and docs.docs:
+            from langchain.vectorstores import FAISS
+
+            docs.doc_index = FAISS.from_texts(
+                [doc.citation for doc in docs.docs.values()],
+                metadatas=[doc.dict() for doc in docs.docs.values()],
+                embedding=docs.embeddings,
+            )
+
+    reloader = LibraryReloader(
+        lambda: open_library(
+            lib_name, index=index, backend=backend, retrieval=retrieval, shared_dir=shared_dir
+        ),
+        lambda: ";".join(library_version(name, shared_dir) for name in lib_names),
+        interval=reload_interval,
+        prepare=prepare,
+        retire=close_library,
+    )
+    answer_cache = None
+    if answer_threshold is not None:
+        answer_cache = AnswerCache(
+            lib_name,
+            reloader.live[0].embeddings,
+            threshold=answer_threshold,
+            shared_dir=shared_dir,
+            scope="%s/%s" % (index, retrieval),
+        )
+    lib_name = ", ".join(lib_names)
+
+    def get_answer(question):
+        # the whole question is answered from the version live when it starts
+        docs, version, _ = reloader.live
+        answer = answer_question(docs, question, answer_cache)
+        print_shard_latencies(docs)
+        if answer_cache is not None:
+            print("Answer cache: %s" % answer_cache.stats())
+        return answer, version_id(version)
+
+    query_pool = QueryPool(get_answer, workers=query_workers, max_queue=max_queue)
+
+    def on_swap(docs, version):
+        query_pool.warm = False
+        if answer_cache is not None:
+            answer_cache.check_version(version)
 
-        answer = None
-        evt = threading.Event()
+    reloader.on_swap = on_swap
+    reloader.start()
 
-        def get_answer():
-            nonlocal answer
-            nonlocal evt
-            answer = "Waiting for PaperQA..."
-            answer = docs.query(question, k=10, max_sources=10).formatted_answer
-            evt.set()
+    async def wait_answer(future):
+        return await asyncio.wrap_future(future)
+
+    @pywebio.config(title="Delt4: PaperQA beta")
+    async def app():
+        pywebio.output.put_markdown("## Delt4: Aging PaperQA beta")
+        stats = reloader.stats()
+        pywebio.output.put_markdown(
+            "Lib name: %s (version %s, loaded %s)" % (lib_name, stats["version"], stats["loaded"])
+        )
 
         while True:
-            answer = None
-            evt = threading.Event()
-            question = pywebio.input.input(
+            question = await pywebio.input.input(
                 "Question", placeholder="Enter your question", required=True
             )
-            thread = threading.Thread(target=get_answer)
-            thread.start()
+            try:
+                future, ahead = query_pool.submit(question)
+            except QueueFull as exception:
+                pywebio.output.put_table([["Q", question], ["A", str(exception)]])
+                continue
+            status = "Waiting for PaperQA..."
+            if ahead > 0:
+                status += " %d questions ahead of yours." % ahead
             with pywebio.output.use_scope("pending"):
-                pywebio.output.put_table([["Q", question], ["A", answer]])
-            while True:
-                if evt.is_set():
-                    break
+                pywebio.output.put_table([["Q", question], ["A", status]])
+            try:
+                answer, version = await run_asyncio_coroutine(wait_answer(future))
+            except Exception as exception:
+                answer = "Failed to answer the question: %s" % exception
+                version = reloader.stats()["version"]
             pywebio.output.remove(scope="pending")
-            pywebio.output.put_table([["Q", question], ["A", answer]])
+            pywebio.output.put_table(
+                [["Q", question], ["A", answer], ["Library version", version]]
+            )
 
-    pywebio.start_server(app, port=port)
+    try:
+        pywebio.start_server(app, port=port)
+    finally:
+        reloader.stop()
+        query_pool.shutdown()
+        close_library(reloader.live[0])
 
 
 if __name__ == "__main__":
     args = get_arguments()
     if args.lib_name is None:
         raise ValueError("Please specify a new or existing library name.")
+    if (args.load is not None or args.convert) and len(args.lib_name) > 1:
+        raise ValueError("Papers can only be loaded into one library at a time.")
+    if args.threads is not None or args.cpu_affinity is not None:
+        set_cpu_threads(args.threads, args.cpu_affinity)
     if args.load is not None:
-        args.lib_name = format_filename(args.lib_name)
-        load_papers(args.load, args.lib_name, args.embeddings)
+        args.lib_name = format_filename(args.lib_name[0])
+        load_papers(
+            args.load,
+            args.lib_name,
+            args.embeddings,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            cache_dir=args.cache_dir,
+            cache_size=int(args.cache_size * 1024**3),
+            index=args.index,
+            trace=args.trace,
+            trace_format=args.trace_format,
+            dedup=args.dedup,
+            prune=args.prune,
+            dtype=args.dtype,
+            chunk_chars=args.chunk_chars,
+            text_cache_dir=args.text_cache_dir,
+            backend=args.embedding_backend,
+            embed_workers=args.embed_workers,
+            embed_threads=args.embed_threads,
+        )
+    elif args.convert:
+        args.lib_name = args.lib_name[0]
+        recall = convert_library(args.lib_name, args.dtype)
+        print("Library converted to the split format in %s" % os.path.abspath(library_path(args.lib_name, ".sqlite")))
+        if recall is not None:
+            print("recall@10 of %s vectors against float32: %.3f" % (args.dtype, recall))
+    elif args.questions_file is not None:
+        docs = open_library(
+            args.lib_name,
+            index=args.index,
+            backend=args.embedding_backend,
+            retrieval=args.retrieval,
+        )
+        run_batch(
+            docs,
+            args.questions_file,
+            args.answers_file,
+            concurrency=args.query_workers,
+            tokens_per_minute=args.tokens_per_minute,
+        )
+        close_library(docs)
     elif args.web:
-        run_webqa(args.lib_name, args.port)
+        run_webqa(
+            args.lib_name,
+            args.port,
+            index=args.index,
+            answer_threshold=None if args.no_answer_cache else args.answer_threshold,
+            query_workers=args.query_workers,
+            max_queue=args.max_queue,
+            backend=args.embedding_backend,
+            retrieval=args.retrieval,
+            shared_dir=args.shared_dir,
+            reload_interval=args.reload_interval,
+        )
     else:
-        run_qa(args.lib_name)
+        run_qa(
+            args.lib_name,
+            index=args.index,
+            answer_threshold=None if args.no_answer_cache else args.answer_threshold,
+            backend=args.embedding_backend,
+            retrieval=args.retrieval,
+        )
@@ -0,0 +1,76 @@
+import numpy as np
+
+DTYPES = ["float32", "float16", "int8"]
+# numpy descr of the stored rows of each dtype
+DESCRS = {"float32": "<f4", "float16": "<f2", "int8": "|i1"}
+
+
+def quantize(vectors, dtype):
+    """Return (rows, scales) storing `vectors` as `dtype`.
+
+    int8 rows are scaled per vector so that the largest component maps to 127;
+    scales is None for float types.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float32":
+        return vectors, None
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype != "int8":
+        raise ValueError("Unknown vector type %s." % dtype)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedVectors:
+    """int8 vectors with a float32 scale per vector, read like a float32 matrix.
+
+    Indexing dequantizes only the selected rows. Searches score the int8
+    codes directly with `dot` and `squared_norms`, using integer dot products
+    and the per-row scales, so no float32 copy of the rows is made.
+    """
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __getitem__(self, key):
+        scales = np.asarray(self.scales[key], dtype=np.float32)
+        return self.codes[key].astype(np.float32) * scales[..., None]
+
+    def dot(self, query, start=0, stop=None):
+        """Dot products of rows start:stop with `query`, which is quantized to int8 too."""
+        query_codes, query_scale = quantize(np.asarray(query, dtype=np.float32)[None, :], "int8")
+        products = np.einsum("ij,j->i", self.codes[start:stop], query_codes[0], dtype=np.int32)
+        return products * (self.scales[start:stop] * query_scale[0])
+
+    def squared_norms(self, start=0, stop=None):
+        codes = self.codes[start:stop]
+        scales = np.asarray(self.scales[start:stop], dtype=np.float32)
+        return np.einsum("ij,ij->i", codes, codes, dtype=np.int32) * scales**2
+
+
+def quantization_recall(vectors, quantized, k=10, num_queries=200):
+    """recall@k of exact search over `quantized` against float32 `vectors`."""
+    from .ann import recall_at_k
+    from .vectorstore import MatrixVectorStore
+
+    return recall_at_k(
+        MatrixVectorStore(vectors, None, None),
+        MatrixVectorStore(quantized, None, None),
+        k=k,
+        num_queries=num_queries,
+    )
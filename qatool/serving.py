@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _new_event_loop():
+    # paperqa runs its async pipeline on the thread's event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+class QueryPool:
+    """Bounded pool of threads answering questions against one loaded library.
+
+    At most `workers` questions run at once and at most `max_queue` more wait
+    for a free worker; `submit` raises QueueFull beyond that instead of
+    letting requests pile up. The library is shared read-only by all workers.
+    The first question runs alone, since paperqa builds its indexes lazily on
+    the first query, and later questions run concurrently. Setting `warm` to
+    False, e.g. when another library goes live, runs the next one alone again.
+    """
+
+    def __init__(self, answer, workers=4, max_queue=32):
+        self.answer = answer
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="qa", initializer=_new_event_loop
+        )
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.warm_lock = threading.Lock()
+        self.warm = False
+        self.completed = 0
+        self.rejected = 0
+
+    def _run(self, question):
+        try:
+            if not self.warm:
+                with self.warm_lock:
+                    result = self.answer(question)
+                    self.warm = True
+                    return result
+            return self.answer(question)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def submit(self, question):
+        """Queue a question. Returns (future, number of questions ahead of it)."""
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise QueueFull(
+                    "%d questions are already waiting, please try again later." % self.max_queue
+                )
+            ahead = max(0, self.pending - self.workers + 1)
+            self.pending += 1
+        return self.executor.submit(self._run, question), ahead
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": min(self.pending, self.workers),
+                "queued": max(0, self.pending - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class LibraryReloader:
+    """Keeps the newest version of a library live in a running server.
+
+    A background thread calls `version()` every `interval` seconds. When the
+    version changed and is still the same at the next check, so papers are
+    no longer being added, `load()` opens the new one while questions are
+    still answered from the live one, and `prepare(docs)` can warm it up. It
+    then goes live with a single assignment of (docs, version, loaded time),
+    `on_swap(docs, version)` is called, and `retire(old_docs)` can release
+    what the replaced version holds. A question reads `live` once and is answered
+    entirely from that version, so none is dropped or sees a half loaded
+    library. If loading fails, the live version is kept and loading is tried
+    again at the next check.
+    """
+
+    def __init__(self, load, version, interval=60, prepare=None, on_swap=None, retire=None):
+        self.load = load
+        self.version = version
+        self.interval = interval
+        self.prepare = prepare
+        self.on_swap = on_swap
+        self.retire = retire
+        # read before loading, so changes made while loading are seen next time
+        version = version()
+        docs = load()
+        if prepare is not None:
+            prepare(docs)
+        self.live = (docs, version, time.time())
+        # changed version seen at the last check, loaded if it is seen again
+        self.pending = None
+        self.reloads = 0
+        self.failures = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def check(self):
+        """Load and swap in the library if its version changed and was the same at
+        the previous check. Returns True if swapped."""
+        version = self.version()
+        if version == self.live[1]:
+            self.pending = None
+            return False
+        if version != self.pending:
+            self.pending = version
+            return False
+        try:
+            docs = self.load()
+            if self.prepare is not None:
+                self.prepare(docs)
+        except Exception as exception:
+            self.failures += 1
+            print("Failed to load the new library version, keeping the live one: %s" % exception)
+            return False
+        old_docs = self.live[0]
+        self.live = (docs, version, time.time())
+        self.pending = None
+        self.reloads += 1
+        print("Library version %s is live." % version_id(version))
+        if self.on_swap is not None:
+            self.on_swap(docs, version)
+        if self.retire is not None:
+            self.retire(old_docs)
+        return True
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self.interval and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="reload", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        _, version, loaded = self.live
+        return {
+            "version": version_id(version),
+            "loaded": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(loaded)),
+            "reloads": self.reloads,
+            "failures": self.failures,
+        }
+
+
+def version_id(version):
+    """Short id of a `library.library_version` fingerprint."""
+    return hashlib.md5(version.encode()).hexdigest()[:8]
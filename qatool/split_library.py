@@ -0,0 +1,273 @@
+import os
+import sqlite3
+import threading
+from itertools import groupby
+import numpy as np
+from langchain.docstore.document import Document
+from .cache import embeddings_name
+from .library import library_path
+from .matrix import NPY_HEADER_SIZE, npy_header
+from .quantize import DESCRS, QuantizedVectors, quantization_recall, quantize
+
+
+class SplitLibrary:
+    """Library stored as a memory-mapped vector matrix and an SQLite chunk store.
+
+    `<lib>.vectors.npy` holds one row per chunk; row `i` is chunk `i` in
+    `<lib>.sqlite`, which also keeps the documents, their citations and the
+    models the library was built with. Rows are float32, float16, or int8 with
+    a per-row scale kept in `<lib>.scales.npy`. The float32 embeddings of the
+    citations, which paperqa searches to pick papers, are kept in
+    `<lib>.citations.npy`, row `i` for the document in row `i` of `citations`. Opening a library reads neither
+    texts nor vectors into memory; texts are fetched only for retrieved chunks.
+    The vectors are mapped read-only, so processes serving the same library
+    share one copy of them in the page cache. With `shared_dir`, the files are
+    read from there instead, e.g. a copy in /dev/shm made by `launch`.
+    """
+
+    def __init__(self, lib_name, shared_dir=None):
+        self.lib_name = lib_name
+        self.shared_dir = shared_dir
+        self.vectors_path = self._path(".vectors.npy")
+        self.scales_path = self._path(".scales.npy")
+        self.citations_path = self._path(".citations.npy")
+        self.db_path = self._path(".sqlite")
+        self.lock = threading.Lock()
+        self._db = None
+
+    def _path(self, ext):
+        if self.shared_dir:
+            return os.path.join(self.shared_dir, self.lib_name + ext)
+        return library_path(self.lib_name, ext)
+
+    def exists(self):
+        return os.path.exists(self.db_path) and os.path.exists(self.vectors_path)
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        return self._db
+
+    def meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def num_rows(self):
+        return int(self.meta("rows", 0))
+
+    def dtype(self):
+        return self.meta("dtype", "float32")
+
+    def create(self, docs, dtype="float32"):
+        """Write `docs` (a paperqa Docs) as a new split library with `dtype` rows."""
+        from .embedding import embed_texts
+
+        for path in (self.db_path, self.vectors_path, self.scales_path, self.citations_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._db = None
+        self.db.executescript(
+            "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE docs (dockey TEXT PRIMARY KEY, docname TEXT, citation TEXT);"
+            "CREATE TABLE chunks (id INTEGER PRIMARY KEY, name TEXT, dockey TEXT, text TEXT);"
+            "CREATE TABLE citations (row INTEGER PRIMARY KEY, dockey TEXT);"
+        )
+        self._set_meta("embeddings", embeddings_name(docs.embeddings))
+        self._set_meta("llm", getattr(docs.llm, "model_name", "gpt-3.5-turbo"))
+        self._set_meta("rows", 0)
+        self._set_meta("dtype", dtype)
+        self.db.commit()
+        with open(self.vectors_path, "wb") as f:
+            f.write(npy_header(0, 0, DESCRS[dtype]))
+        if dtype == "int8":
+            with open(self.scales_path, "wb") as f:
+                f.write(npy_header(0, None))
+        with open(self.citations_path, "wb") as f:
+            f.write(npy_header(0, 0))
+        texts = [t for t in docs.texts if t.doc.dockey not in docs.deleted_dockeys]
+        groups = [list(g) for _, g in groupby(texts, key=lambda t: t.doc.dockey)]
+        citation_vectors = embed_texts(docs.embeddings, [g[0].doc.citation for g in groups])
+        for doc_texts, citation_vector in zip(groups, citation_vectors):
+            self.append(doc_texts[0].doc, doc_texts, citation_vector, sync=False)
+        self.db.commit()
+
+    def append(self, doc, texts, citation_vector=None, sync=True):
+        """Append one document's embedded texts to the library.
+
+        The vectors are written past the rows recorded in the header first,
+        then the chunks are committed to SQLite, and only then is the header
+        row count updated, so an interrupted append leaves the library as it
+        was before. `citation_vector` is the embedding of `doc.citation`;
+        libraries created before citations were stored skip it.
+        """
+        rows = self.num_rows()
+        dim = int(self.meta("dim", 0)) or len(texts[0].embeddings)
+        dtype = self.dtype()
+        vectors, scales = quantize([t.embeddings for t in texts], dtype)
+        if vectors.shape[1] != dim:
+            raise ValueError("Embedding size %d does not match library size %d." % (vectors.shape[1], dim))
+        self._write_rows(self.vectors_path, rows * dim * vectors.itemsize, vectors, sync)
+        if scales is not None:
+            self._write_rows(self.scales_path, rows * 4, scales, sync)
+        self.db.execute(
+            "INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+            (doc.dockey, doc.docname, doc.citation),
+        )
+        citation_rows = None
+        if citation_vector is not None and os.path.exists(self.citations_path):
+            citation_rows = int(self.meta("citation_rows", 0))
+            citation_vector = np.asarray([citation_vector], dtype=np.float32)
+            self._write_rows(
+                self.citations_path, citation_rows * dim * 4, citation_vector, sync
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO citations VALUES (?, ?)", (citation_rows, doc.dockey)
+            )
+            self._set_meta("citation_rows", citation_rows + 1)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+            [(rows + i, t.name, doc.dockey, t.text) for i, t in enumerate(texts)],
+        )
+        self._set_meta("dim", dim)
+        self._set_meta("rows", rows + len(texts))
+        if sync:
+            self.db.commit()
+        with open(self.vectors_path, "r+b") as f:
+            f.write(npy_header(rows + len(texts), dim, DESCRS[dtype]))
+        if scales is not None:
+            with open(self.scales_path, "r+b") as f:
+                f.write(npy_header(rows + len(texts), None))
+        if citation_rows is not None:
+            with open(self.citations_path, "r+b") as f:
+                f.write(npy_header(citation_rows + 1, dim))
+
+    @staticmethod
+    def _write_rows(path, offset, array, sync):
+        with open(path, "r+b") as f:
+            f.truncate(NPY_HEADER_SIZE + offset)
+            f.seek(0, os.SEEK_END)
+            f.write(array.tobytes())
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def vectors(self):
+        rows, dim = self.num_rows(), int(self.meta("dim", 0))
+        if rows == 0:
+            return np.empty((0, dim), dtype=np.float32)
+        dtype = self.dtype()
+        vectors = np.memmap(
+            self.vectors_path,
+            dtype=DESCRS[dtype],
+            mode="r",
+            offset=NPY_HEADER_SIZE,
+            shape=(rows, dim),
+        )
+        if dtype != "int8":
+            return vectors
+        scales = np.memmap(
+            self.scales_path, dtype="<f4", mode="r", offset=NPY_HEADER_SIZE, shape=(rows,)
+        )
+        return QuantizedVectors(vectors, scales)
+
+    def check_quantization(self, docs, k=10, num_queries=200):
+        """recall@k of search over the stored rows against the float32 vectors of `docs`."""
+        texts = [t for t in docs.texts if t.doc.dockey not in docs.deleted_dockeys]
+        vectors = np.asarray([t.embeddings for t in texts], dtype=np.float32)
+        return quantization_recall(vectors, self.vectors(), k=k, num_queries=num_queries)
+
+    def citation_index(self, docs):
+        """FAISS index over the stored citation embeddings, as paperqa's `doc_index`.
+
+        Returns None when the library has no complete set of them, in which
+        case paperqa embeds the citations itself.
+        """
+        if not os.path.exists(self.citations_path):
+            return None
+        rows, dim = int(self.meta("citation_rows", 0)), int(self.meta("dim", 0))
+        with self.lock:
+            dockeys = [
+                row[0]
+                for row in self.db.execute("SELECT dockey FROM citations ORDER BY row").fetchall()
+            ]
+        if rows == 0 or rows != len(docs.docs) or set(dockeys) != set(docs.docs):
+            return None
+        from langchain.vectorstores import FAISS
+
+        vectors = np.memmap(
+            self.citations_path, dtype="<f4", mode="r", offset=NPY_HEADER_SIZE, shape=(rows, dim)
+        )
+        return FAISS.from_embeddings(
+            [(docs.docs[dockey].citation, vectors[i].tolist()) for i, dockey in enumerate(dockeys)],
+            docs.embeddings,
+            metadatas=[docs.docs[dockey].dict() for dockey in dockeys],
+        )
+
+    def lookup(self, ids):
+        """Documents for chunk ids, in the order given."""
+        ids = [int(i) for i in ids]
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT c.id, c.name, c.text, d.docname, d.citation, d.dockey "
+                "FROM chunks c JOIN docs d ON c.dockey = d.dockey "
+                "WHERE c.id IN (%s)" % ",".join("?" * len(ids)),
+                ids,
+            ).fetchall()
+        found = {
+            row[0]: Document(
+                page_content=row[2],
+                metadata={
+                    "name": row[1],
+                    "doc": {"docname": row[3], "citation": row[4], "dockey": row[5]},
+                },
+            )
+            for row in rows
+        }
+        return [found[i] for i in ids]
+
+    def load_docs(self, embeddings=None, index="flat", llm=None):
+        """Build a paperqa Docs whose texts index searches this library lazily.
+
+        `index` selects an ANN index built by `ann.build_index`, or "flat" for
+        exact search over all vectors. Only the name of the LLM is stored, so
+        pass `llm` to answer with a model object other than the named one.
+        """
+        from paperqa import Docs
+        from paperqa.types import Doc
+        from .embedding import get_embedding_model
+        from .vectorstore import MatrixVectorStore
+
+        if embeddings is None:
+            embeddings = get_embedding_model(self.meta("embeddings"))
+        docs = Docs(llm=self.meta("llm") if llm is None else llm, embeddings=embeddings)
+        with self.lock:
+            rows = self.db.execute("SELECT dockey, docname, citation FROM docs").fetchall()
+        for dockey, docname, citation in rows:
+            docs.docs[dockey] = Doc(docname=docname, citation=citation, dockey=dockey)
+            docs.docnames.add(docname)
+        vectors = self.vectors()
+        ann_index = None
+        if index != "flat":
+            from .ann import ANNIndex
+
+            ann_index = ANNIndex(self.lib_name, index, shared_dir=self.shared_dir)
+            if not ann_index.exists():
+                raise FileNotFoundError(
+                    "No %s index for library %s, build it with --load and --index."
+                    % (index, self.lib_name)
+                )
+            # workers map the shared copy, which launch keeps up to date
+            ann_index.load(mmap=bool(self.shared_dir))
+            if self.shared_dir and len(ann_index) < len(vectors):
+                ann_index.load()
+            # cover papers appended since the index was saved
+            ann_index.update(vectors)
+        docs.texts_index = MatrixVectorStore(
+            vectors, embeddings, self.lookup, index=ann_index
+        )
+        docs.doc_index = self.citation_index(docs)
+        return docs
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Records wall time of ingest stages, per file where there is one.
+
+    Every event is (stage, file, start, seconds, count, pid, tid), with start
+    taken from `time.time()` so events measured in parse worker processes line
+    up with the main process. Events can be saved as a JSON list or in Chrome
+    trace-event format (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, stage, start, seconds, file=None, count=1, pid=None, tid=None):
+        event = {
+            "stage": stage,
+            "file": file,
+            "start": start,
+            "seconds": seconds,
+            "count": count,
+            "pid": os.getpid() if pid is None else pid,
+            "tid": threading.get_ident() if tid is None else tid,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, stage, file=None, count=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.time() - start, file=file, count=count)
+
+    def stage_summary(self):
+        summary = defaultdict(lambda: {"seconds": 0.0, "events": 0, "count": 0})
+        for event in self.events:
+            stage = summary[event["stage"]]
+            stage["seconds"] += event["seconds"]
+            stage["events"] += 1
+            stage["count"] += event["count"]
+        return dict(summary)
+
+    def slowest_files(self, n=10):
+        files = defaultdict(lambda: defaultdict(float))
+        for event in self.events:
+            if event["file"] is not None:
+                files[event["file"]][event["stage"]] += event["seconds"]
+        ranked = sorted(files.items(), key=lambda item: -sum(item[1].values()))
+        return [(f, dict(stages)) for f, stages in ranked[:n]]
+
+    def save_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "events": self.events,
+                    "stages": self.stage_summary(),
+                    "slowest_files": self.slowest_files(),
+                },
+                f,
+                indent=1,
+            )
+
+    def save_chrome(self, path):
+        trace_events = [
+            {
+                "name": event["stage"],
+                "cat": "ingest",
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["seconds"] * 1e6,
+                "pid": event["pid"],
+                "tid": event["tid"],
+                "args": {"file": event["file"], "count": event["count"]},
+            }
+            for event in self.events
+        ]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+    def save(self, path, trace_format="json"):
+        if trace_format == "chrome":
+            self.save_chrome(path)
+        else:
+            self.save_json(path)
+
+    def print_summary(self, n=10):
+        print("%-12s %10s %8s %10s" % ("stage", "seconds", "events", "count"))
+        for stage, summary in sorted(self.stage_summary().items(), key=lambda item: -item[1]["seconds"]):
+            print("%-12s %10.2f %8d %10d" % (stage, summary["seconds"], summary["events"], summary["count"]))
+        print("\nSlowest files:")
+        for f, stages in self.slowest_files(n):
+            detail = ", ".join("%s %.2fs" % (stage, seconds) for stage, seconds in stages.items())
+            print("%8.2fs  %s (%s)" % (sum(stages.values()), f, detail))
+
+
+class NullTracer:
+    """Tracer that records nothing, used when tracing is off."""
+
+    def add(self, *args, **kwargs):
+        pass
+
+    @contextmanager
+    def span(self, *args, **kwargs):
+        yield
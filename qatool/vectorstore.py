@@ -0,0 +1,187 @@
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+from .quantize import QuantizedVectors
+
+
+def maximal_marginal_relevance(query, candidates, k, lambda_mult=0.5):
+    """Indices into `candidates` chosen by maximal marginal relevance."""
+    if len(candidates) == 0:
+        return []
+    candidates = candidates / np.maximum(
+        np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12
+    )
+    query = query / max(np.linalg.norm(query), 1e-12)
+    relevance = candidates @ query
+    selected = [int(np.argmax(relevance))]
+    redundancy = candidates @ candidates[selected[0]]
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        i = int(np.argmax(scores))
+        selected.append(i)
+        redundancy = np.maximum(redundancy, candidates @ candidates[i])
+    return selected
+
+
+class MatrixVectorStore(VectorStore):
+    """Vector store over an embedding matrix that may be memory-mapped.
+
+    The store only holds vectors. Texts and metadata of the rows a search
+    returns are fetched with `lookup(ids)`, so a library can be searched
+    without loading its chunk texts. Like the FAISS index paperqa builds by
+    default, rows are ranked by L2 distance. Vectors added after loading are
+    kept in memory next to the matrix. If an `index` (see `ann.ANNIndex`)
+    covers the matrix, it is searched instead of scanning every row.
+    """
+
+    def __init__(self, vectors, embedding, lookup, block_rows=65536, index=None):
+        self.vectors = vectors
+        self.embedding = embedding
+        self.lookup = lookup
+        self.block_rows = block_rows
+        self.index = index
+        self.added_vectors = []
+        self.added_documents = []
+        self._squared_norms = None
+
+    def __len__(self):
+        return len(self.vectors) + len(self.added_vectors)
+
+    def _blocks(self):
+        for start in range(0, len(self.vectors), self.block_rows):
+            yield start, np.asarray(
+                self.vectors[start : start + self.block_rows], dtype=np.float32
+            )
+        if self.added_vectors:
+            yield len(self.vectors), np.asarray(self.added_vectors, dtype=np.float32)
+
+    def _block_dots(self, query):
+        """(start, dot products with `query`) of every block of rows."""
+        if not isinstance(self.vectors, QuantizedVectors):
+            for start, block in self._blocks():
+                yield start, block @ query
+            return
+        # int8 rows are scored on their codes, without a float32 copy
+        for start in range(0, len(self.vectors), self.block_rows):
+            yield start, self.vectors.dot(query, start, start + self.block_rows)
+        if self.added_vectors:
+            yield len(self.vectors), np.asarray(self.added_vectors, dtype=np.float32) @ query
+
+    def squared_norms(self):
+        if self._squared_norms is None or len(self._squared_norms) != len(self):
+            if isinstance(self.vectors, QuantizedVectors):
+                norms = [self.vectors.squared_norms()]
+                if self.added_vectors:
+                    added = np.asarray(self.added_vectors, dtype=np.float32)
+                    norms.append(np.einsum("ij,ij->i", added, added))
+            else:
+                norms = [np.einsum("ij,ij->i", block, block) for _, block in self._blocks()]
+            self._squared_norms = np.concatenate(norms or [np.empty(0, dtype=np.float32)])
+        return self._squared_norms
+
+    def get_vectors(self, ids):
+        rows = []
+        for i in ids:
+            if i < len(self.vectors):
+                rows.append(np.asarray(self.vectors[i], dtype=np.float32))
+            else:
+                rows.append(np.asarray(self.added_vectors[i - len(self.vectors)], dtype=np.float32))
+        return np.stack(rows) if rows else np.empty((0, 0), dtype=np.float32)
+
+    def get_documents(self, ids):
+        base_ids = [i for i in ids if i < len(self.vectors)]
+        found = dict(zip(base_ids, self.lookup(base_ids))) if base_ids else {}
+        for i in ids:
+            if i >= len(self.vectors):
+                found[i] = self.added_documents[i - len(self.vectors)]
+        return [found[i] for i in ids]
+
+    def exact_search(self, query, fetch_k):
+        """Ids and squared L2 distances of the `fetch_k` nearest rows, nearest first."""
+        query = np.asarray(query, dtype=np.float32)
+        norms = self.squared_norms()
+        best_ids = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0, dtype=np.float32)
+        for start, dots in self._block_dots(query):
+            distances = norms[start : start + len(dots)] - 2 * dots
+            ids = np.arange(start, start + len(dots))
+            best_ids = np.concatenate([best_ids, ids])
+            best_distances = np.concatenate([best_distances, distances])
+            if len(best_ids) > fetch_k:
+                keep = np.argpartition(best_distances, fetch_k)[:fetch_k]
+                best_ids = best_ids[keep]
+                best_distances = best_distances[keep]
+        order = np.argsort(best_distances)
+        return best_ids[order], best_distances[order] + query @ query
+
+    def search(self, query, fetch_k):
+        if self.index is None or len(self.index) < len(self.vectors):
+            return self.exact_search(query, fetch_k)
+        query = np.asarray(query, dtype=np.float32)
+        ids, distances = self.index.search(query, fetch_k)
+        if self.added_vectors:
+            added = np.asarray(self.added_vectors, dtype=np.float32) - query
+            ids = np.concatenate([ids, len(self.vectors) + np.arange(len(added))])
+            distances = np.concatenate([distances, np.einsum("ij,ij->i", added, added)])
+            order = np.argsort(distances)[:fetch_k]
+            ids, distances = ids[order], distances[order]
+        return ids, distances
+
+    def add_embeddings(self, text_embeddings, metadatas=None, **kwargs):
+        text_embeddings = list(text_embeddings)
+        if metadatas is None:
+            metadatas = [{} for _ in text_embeddings]
+        ids = []
+        for (text, vector), metadata in zip(text_embeddings, metadatas):
+            ids.append(str(len(self)))
+            self.added_vectors.append(vector)
+            self.added_documents.append(Document(page_content=text, metadata=metadata))
+        return ids
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        vectors = self.embedding.embed_documents(texts)
+        return self.add_embeddings(zip(texts, vectors), metadatas)
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        ids, distances = self.search(embedding, k)
+        documents = self.get_documents([int(i) for i in ids])
+        return list(zip(documents, [float(d) for d in distances]))
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [
+            document
+            for document, _ in self.similarity_search_with_score_by_vector(embedding, k)
+        ]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k)
+
+    def max_marginal_relevance_search_by_vector(
+        self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs
+    ):
+        ids, _ = self.search(embedding, fetch_k)
+        ids = [int(i) for i in ids]
+        selected = maximal_marginal_relevance(
+            np.asarray(embedding, dtype=np.float32), self.get_vectors(ids), k, lambda_mult
+        )
+        return self.get_documents([ids[i] for i in selected])
+
+    def max_marginal_relevance_search(
+        self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs
+    ):
+        embedding = self.embedding.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(
+            embedding, k, fetch_k, lambda_mult
+        )
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        store = cls(np.empty((0, 0), dtype=np.float32), embedding, lambda ids: [])
+        store.add_texts(texts, metadatas)
+        return store
@@ -0,0 +1,24 @@
+import pytest
+from qatool import library
+
+
+@pytest.fixture
+def lib_dir(tmp_path, monkeypatch):
+    """Keep the library files of a test in its own directory."""
+    monkeypatch.setattr(library, "LIB_DIR", str(tmp_path))
+    return tmp_path
+
+
+def make_texts(dockey, vectors, words="aging"):
+    from paperqa.types import Doc, Text
+
+    doc = Doc(docname=dockey, citation="Citation of %s" % dockey, dockey=dockey)
+    return doc, [
+        Text(
+            text="%s chunk %d %s" % (dockey, i, words),
+            name="%s chunk %d" % (dockey, i),
+            doc=doc,
+            embeddings=list(vector),
+        )
+        for i, vector in enumerate(vectors)
+    ]
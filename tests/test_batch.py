@@ -0,0 +1,18 @@
+import asyncio
+from qatool.batch import TokenRateLimiter
+
+
+def test_failed_question_releases_reservation():
+    limiter = TokenRateLimiter(tokens_per_minute=1000, estimate=800)
+    reserved = asyncio.run(limiter.acquire())
+    limiter.record(reserved, 0)
+    assert limiter._in_window() == 0
+    assert limiter.estimate == 800
+
+
+def test_record_corrects_estimate():
+    limiter = TokenRateLimiter(tokens_per_minute=1000, estimate=800)
+    reserved = asyncio.run(limiter.acquire())
+    limiter.record(reserved, 300)
+    assert limiter._in_window() == 300
+    assert limiter.estimate == 300
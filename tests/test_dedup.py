@@ -0,0 +1,48 @@
+import random
+from types import SimpleNamespace
+from qatool.dedup import ChunkDeduplicator
+
+
+def chunk(text, dockey, name="chunk 0"):
+    return SimpleNamespace(text=text, name=name, doc=SimpleNamespace(docname=dockey, dockey=dockey))
+
+
+def words(rng, n):
+    return " ".join("w%d" % rng.randrange(5000) for _ in range(n))
+
+
+def test_abstract_after_full_text_is_dropped():
+    rng = random.Random(0)
+    abstract = words(rng, 200)
+    full_text = abstract + " " + words(rng, 300)
+    dedup = ChunkDeduplicator()
+    assert dedup.keep("paper.pdf", [chunk(full_text, "pdf")]) == [0]
+    assert dedup.keep("paper.txt", [chunk(abstract, "txt"), chunk(words(rng, 200), "txt", "chunk 1")]) == [1]
+    assert dedup.duplicates[0]["duplicate_of"] == ["paper.pdf", "chunk 0"]
+
+
+def test_abstract_before_full_text_is_superseded():
+    rng = random.Random(1)
+    abstract = words(rng, 200)
+    full_text = abstract + " " + words(rng, 300)
+    dedup = ChunkDeduplicator()
+    dedup.seed([chunk(abstract, "txt")])
+    assert dedup.keep("paper.pdf", [chunk(full_text, "pdf")]) == [0]
+    assert dedup.superseded_dockeys() == {"txt"}
+
+
+def test_partly_contained_paper_is_not_superseded():
+    rng = random.Random(2)
+    abstract = words(rng, 200)
+    dedup = ChunkDeduplicator()
+    dedup.seed([chunk(abstract, "txt"), chunk(words(rng, 200), "txt", "chunk 1")])
+    dedup.keep("paper.pdf", [chunk(abstract + " " + words(rng, 300), "pdf")])
+    assert dedup.superseded_dockeys() == set()
+
+
+def test_seed_skips_deleted_documents():
+    rng = random.Random(3)
+    text = words(rng, 200)
+    dedup = ChunkDeduplicator()
+    dedup.seed([chunk(text, "old")], deleted_dockeys={"old"})
+    assert dedup.keep("new.txt", [chunk(text, "new")]) == [0]
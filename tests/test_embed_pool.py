@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import pytest
+from qatool import embed_pool
+from qatool.embed_pool import EmbeddingWorkerPool
+
+
+def _crashing_worker(name, backend, threads, cpus, conn):
+    # stands in for embed_pool._worker: a text's vector is [length, 0], the
+    # text "crash" kills the first worker given it and "always" every one;
+    # `name` is the marker file of the first crash
+    conn.send((None, None, None))
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        shard, texts, batch_size = task
+        if "always" in texts or ("crash" in texts and not os.path.exists(name)):
+            open(name, "w").close()
+            os._exit(3)
+        conn.send((shard, np.asarray([[len(t), 0.0] for t in texts], dtype=np.float32), None))
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(embed_pool, "_worker", _crashing_worker)
+    with EmbeddingWorkerPool(str(tmp_path / "crashed"), workers=2, batch_size=4) as pool:
+        yield pool
+
+
+def test_crashed_shard_is_queued_again(pool):
+    texts = ["x" * (i % 7) + str(i) for i in range(40)]
+    texts[17] = "crash"
+    vectors = pool.embed_documents(texts)
+    assert [vector[0] for vector in vectors] == [len(t) for t in texts]
+    assert pool.restarts == 1
+
+
+def test_shard_crashing_every_worker_raises(pool):
+    with pytest.raises(RuntimeError):
+        pool.embed_documents(["always"] + ["text %d" % i for i in range(10)])
+    # the replaced workers serve later calls
+    assert pool.embed_query("after") == [5.0, 0.0]
@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("lxml")
+
+from qatool.html_text import html_to_text
+
+
+def page(body):
+    return "<html><body>%s</body></html>" % body
+
+
+def test_mixed_content_keeps_container_text():
+    text = html_to_text(
+        page(
+            '<article><h1>T</h1><div class="sec">Intro text that is long. '
+            '<div class="fig">Fig 1</div> Continues here with results.</div></article>'
+        )
+    )
+    assert text.split("\n\n") == [
+        "# T",
+        "Intro text that is long.",
+        "Fig 1",
+        "Continues here with results.",
+    ]
+
+
+def test_inline_text_and_line_breaks():
+    text = html_to_text(page("<span>Bare span</span> and body text<p>First line<br>Second line</p>"))
+    assert text.split("\n\n") == ["Bare span and body text", "First line Second line"]
+
+
+def test_boilerplate_and_references_are_dropped():
+    text = html_to_text(
+        page(
+            '<nav>Menu</nav><div class="container with-sidebar"><main><p>Results.</p>'
+            '<h2>References</h2><p>1. Someone 2020.</p><h2>Discussion</h2><p>More.</p></main>'
+            '<div class="sidebar">Related</div></div>'
+        )
+    )
+    assert text.split("\n\n") == ["Results.", "## Discussion", "More."]
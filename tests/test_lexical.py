@@ -0,0 +1,56 @@
+from qatool.lexical import BM25Index, tokenize
+
+
+def test_tokenize_joins_hyphenated_names():
+    assert tokenize("IL-6 in the mTORC1 pathway") == ["il", "6", "mtorc1", "pathway", "il6"]
+
+
+def test_search_ranks_rare_terms(lib_dir):
+    index = BM25Index("lib")
+    index.create(
+        [
+            "aging and senescence in mouse liver",
+            "FOXO3 variants and longevity in humans",
+            "aging aging aging of muscle",
+            "IL-6 levels rise with age",
+        ]
+    )
+    ids, scores = index.search("What does FOXO3 do in aging?", 4)
+    assert ids[0] == 1
+    assert list(scores) == sorted(scores, reverse=True)
+    assert set(ids) == {0, 1, 2}
+    assert index.search("IL6", 2)[0].tolist() == [3]
+
+
+def test_search_without_matches(lib_dir):
+    index = BM25Index("lib")
+    index.create(["aging in mice"])
+    assert len(index.search("zebrafish", 5)[0]) == 0
+    assert len(index.search("", 5)[0]) == 0
+
+
+def test_append_extends_ids(lib_dir):
+    index = BM25Index("lib")
+    index.create(["aging in mice", "aging in flies"])
+    index.append(["rapamycin extends lifespan"])
+    assert BM25Index("lib").num_rows() == 3
+    assert index.search("rapamycin", 3)[0].tolist() == [2]
+
+
+class WordEmbeddings:
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [float("aging" in text), float("FOXO3" in text)]
+
+
+def test_hybrid_from_texts_in_memory(lib_dir):
+    from qatool.lexical import HybridVectorStore
+
+    store = HybridVectorStore.from_texts(["aging in mice", "zebrafish fins"], WordEmbeddings())
+    store.add_embeddings([("FOXO3 and aging", [1.0, 1.0])], [{"name": "added"}])
+    assert list(lib_dir.iterdir()) == []
+    assert store.lexical.num_rows() == 3
+    documents = store.similarity_search("FOXO3", k=1)
+    assert documents[0].metadata == {"name": "added"}
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+from qatool.library import LibraryJournal, LibraryWriter, library_path
+from qatool.split_library import SplitLibrary
+from .conftest import make_texts
+from .test_split_library import make_docs
+
+
+def test_journal_repair_cuts_torn_record(lib_dir):
+    journal = LibraryJournal(library_path("lib", ".journal"))
+    for dockey in ("a", "b"):
+        journal.append(*make_texts(dockey, [[1.0, 0.0]]))
+    size = journal.size()
+    # a record cut off by a crash while it was written
+    with open(journal.path, "ab") as f:
+        f.write(journal.header.pack(1000, 0) + b"partial")
+    assert [doc.dockey for doc, _ in journal.records()] == ["a", "b"]
+    journal.repair()
+    assert journal.size() == size
+    journal.append(*make_texts("c", [[0.0, 1.0]]))
+    assert [doc.dockey for doc, _ in journal.records()] == ["a", "b", "c"]
+
+
+def test_journal_repair_cuts_corrupt_record(lib_dir):
+    journal = LibraryJournal(library_path("lib", ".journal"))
+    journal.append(*make_texts("a", [[1.0, 0.0]]))
+    size = journal.size()
+    journal.append(*make_texts("b", [[1.0, 0.0]]))
+    with open(journal.path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    journal.repair()
+    assert journal.size() == size
+    assert [doc.dockey for doc, _ in journal.records()] == ["a"]
+
+
+def test_journal_repair_without_journal(lib_dir):
+    journal = LibraryJournal(library_path("lib", ".journal"))
+    journal.repair()
+    assert journal.size() == 0
+    assert list(journal.records()) == []
+
+
+def test_writer_appends_rows_missing_from_split(lib_dir):
+    rng = np.random.default_rng(0)
+    a, b = rng.normal(size=(2, 3, 8)).astype(np.float32)
+    SplitLibrary("lib").create(make_docs({"a": a}))
+    # b was journaled, but the process stopped before it reached the split copy
+    writer = LibraryWriter(make_docs({"a": a, "b": b}), "lib")
+    assert writer.split.num_rows() == 6
+    np.testing.assert_array_equal(writer.split.vectors(), np.concatenate([a, b]))
+    assert writer.split.lookup([5])[0].metadata["doc"]["dockey"] == "b"
+
+
+def test_writer_rebuilds_mismatched_split(lib_dir):
+    rng = np.random.default_rng(1)
+    a, b = rng.normal(size=(2, 3, 8)).astype(np.float32)
+    SplitLibrary("lib").create(make_docs({"a": a, "b": b}))
+    writer = LibraryWriter(make_docs({"b": b}), "lib")
+    np.testing.assert_array_equal(writer.split.vectors(), b)
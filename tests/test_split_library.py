@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from qatool.quantize import QuantizedVectors
+from qatool.split_library import SplitLibrary
+from .conftest import make_texts
+
+
+class CitationEmbeddings:
+    model_name = "test-model"
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def embed_documents(self, texts):
+        return [[float(len(text))] * self.dim for text in texts]
+
+
+def make_docs(vectors_by_doc, dim=8):
+    texts = []
+    for dockey, vectors in vectors_by_doc.items():
+        texts.extend(make_texts(dockey, vectors)[1])
+    return SimpleNamespace(
+        embeddings=CitationEmbeddings(dim),
+        llm="test-llm",
+        texts=texts,
+        deleted_dockeys=set(),
+    )
+
+
+def test_append_and_vectors(lib_dir):
+    rng = np.random.default_rng(0)
+    a, b, c = rng.normal(size=(3, 4, 8)).astype(np.float32)
+    split = SplitLibrary("lib")
+    split.create(make_docs({"a": a, "b": b}))
+    split.append(*make_texts("c", c))
+    vectors = SplitLibrary("lib").vectors()
+    assert vectors.shape == (12, 8)
+    np.testing.assert_array_equal(vectors, np.concatenate([a, b, c]))
+    documents = split.lookup([9, 0])
+    assert documents[0].metadata["name"] == "c chunk 1"
+    assert documents[0].metadata["doc"]["dockey"] == "c"
+    assert documents[1].page_content.startswith("a chunk 0")
+
+
+def test_append_wrong_size_keeps_library(lib_dir):
+    split = SplitLibrary("lib")
+    split.create(make_docs({"a": np.ones((2, 8), dtype=np.float32)}))
+    with pytest.raises(ValueError):
+        split.append(*make_texts("b", np.ones((1, 4), dtype=np.float32)))
+    assert split.num_rows() == 2
+    assert split.vectors().shape == (2, 8)
+
+
+def test_int8_vectors(lib_dir):
+    rng = np.random.default_rng(1)
+    a, b = rng.normal(size=(2, 5, 16)).astype(np.float32)
+    split = SplitLibrary("lib")
+    split.create(make_docs({"a": a}, dim=16), dtype="int8")
+    split.append(*make_texts("b", b))
+    vectors = split.vectors()
+    assert isinstance(vectors, QuantizedVectors)
+    assert vectors.shape == (10, 16)
+    expected = np.concatenate([a, b])
+    np.testing.assert_allclose(vectors[:], expected, atol=np.abs(expected).max() / 127)
+    query = rng.normal(size=16).astype(np.float32)
+    np.testing.assert_allclose(vectors.dot(query), expected @ query, rtol=0.05, atol=0.2)
+
+
+def test_empty_library_vectors(lib_dir):
+    split = SplitLibrary("lib")
+    split.create(make_docs({}))
+    assert split.vectors().shape[0] == 0
+
+
+def test_citation_vectors(lib_dir):
+    rng = np.random.default_rng(2)
+    a, b = rng.normal(size=(2, 3, 8)).astype(np.float32)
+    split = SplitLibrary("lib")
+    split.create(make_docs({"a": a}))
+    doc, texts = make_texts("b", b)
+    split.append(doc, texts, [2.0] * 8)
+    citations = np.load(split.citations_path)
+    np.testing.assert_array_equal(citations, [[len("Citation of a")] * 8, [2.0] * 8])
+    assert split.db.execute("SELECT dockey FROM citations ORDER BY row").fetchall() == [
+        ("a",),
+        ("b",),
+    ]
+    # a paper appended without its citation embedding leaves them incomplete
+    split.append(*make_texts("c", a))
+    docs = SimpleNamespace(docs={key: None for key in "abc"})
+    assert split.citation_index(docs) is None